@@ -0,0 +1,87 @@
+"""
+How much CPU playing a song takes, through the PCM path we used to have
+(ffmpeg decodes, we encode to Opus) and the Opus path (ffmpeg copies or
+encodes the Opus itself). The samples are CPU seconds for the whole song,
+ffmpeg's and ours together, so ops/s is seconds of audio per CPU second.
+"""
+
+from pathlib import Path
+import resource
+import subprocess
+import tempfile
+import time
+from typing import Callable, Dict, List, Optional
+
+from harness import result
+from stubs import make_wav
+
+SECONDS = 20
+
+
+def run(sizes: List[int]) -> List[Dict]:
+    import discord
+    from cogs.music.player import MusicPlayer, ffmpeg_encodes_opus
+    from cogs.music.song import Song
+
+    results = []
+
+    # Songs from YouTube are usually Opus already, which is what the Opus
+    # path can pass on without encoding
+    with tempfile.TemporaryDirectory() as directory:
+        wav = Path(directory) / "song.wav"
+        wav.write_bytes(make_wav(SECONDS))
+
+        if ffmpeg_encodes_opus():
+            path, codec = Path(directory) / "song.ogg", 'opus'
+            subprocess.run(['ffmpeg', '-v', 'error', '-i', str(wav), '-c:a', 'libopus', str(path)], check=True)
+        else:
+            path, codec = wav, 'pcm_s16le'
+
+        song = Song("playback", str(path), SECONDS, 48000, codec=codec)
+
+        # Our own encoding is only measured if discord.py can load libopus
+        encoder = discord.opus.Encoder() if discord.opus.is_loaded() or discord.opus._load_default() else None
+        pcm_name = "pcm" if encoder else "pcm no encode"
+
+        cases = [
+            (pcm_name, False, ""),
+            (f"{pcm_name} + loudnorm", False, "-af loudnorm"),
+            ("opus", True, ""),
+            ("opus + volume", True, "-af volume=3dB"),
+            ("opus + loudnorm", True, "-af loudnorm"),
+        ]
+
+        for name, use_opus, filters in cases:
+            options = {'options': f"-vn -loglevel error {filters}".strip()}
+            player = MusicPlayer(None, song, lambda song: dict(options), None, use_opus=use_opus)
+
+            encode = encoder.encode if encoder and not use_opus else None
+            samples = [_cpu_seconds(lambda: player.make_source(song), encode) for _ in range(3)]
+
+            results.append(result(f"playback.cpu {name}[{SECONDS} s]", samples, SECONDS))
+
+    return results
+
+
+def _cpu_seconds(make_source: Callable, encode: Optional[Callable] = None) -> float:
+    """
+    The CPU time of reading a whole source, including the ffmpeg process
+    behind it, and of encoding every frame with encode if it is given.
+    """
+
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.process_time()
+
+    source = make_source()
+
+    while (frame := source.read()):
+        if encode:
+            encode(frame, 960)
+
+    # Waits for ffmpeg, so that its CPU time is counted
+    source.cleanup()
+
+    own = time.process_time() - start
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    return own + (after.ru_utime - children.ru_utime) + (after.ru_stime - children.ru_stime)
@@ -0,0 +1,83 @@
+"""
+The SongQueue operations and the rendering of the queue message, on
+synthetic queues of different sizes.
+"""
+
+import asyncio
+import random
+from types import SimpleNamespace
+from typing import Dict, List
+
+from harness import measure
+
+
+def make_songs(count: int) -> List:
+    from cogs.music.song import Song
+
+    return [Song(f"Song number {i} " + "x" * random.randint(0, 40), None, random.uniform(60, 600), 48000,
+                 f"https://www.youtube.com/watch?v={i}", str(i)) for i in range(count)]
+
+
+def make_queue(songs: List, current: int = 0):
+    from config import config
+    from cogs.music.song_queue import SongQueue
+
+    queue = SongQueue(config)
+    queue.replace(list(songs), current)
+    return queue
+
+
+def run(sizes: List[int]) -> List[Dict]:
+    from config import config, GuildConfig
+    from cogs.music.guild_music import GuildMusic
+    from cogs.music.resolver import Resolver
+
+    results = []
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    for size in sizes:
+        songs = make_songs(size)
+
+        results.append(measure(f"queue.add_songs[{size}]", lambda queue: queue.add_songs(songs),
+                               setup=lambda: make_queue([]), ops=size))
+
+        results.append(measure(f"queue.add_song x100[{size}]",
+                               lambda queue: [queue.add_song(song) for song in songs[:100]],
+                               setup=lambda: make_queue(songs), ops=100))
+
+        results.append(measure(f"queue.remove_ranges every other[{size}]",
+                               lambda queue: queue.remove_ranges([(i, i) for i in range(1, size + 1, 2)]),
+                               setup=lambda: make_queue(songs), ops=size // 2))
+
+        results.append(measure(f"queue.remove_range half[{size}]",
+                               lambda queue: queue.remove_range(1, size // 2),
+                               setup=lambda: make_queue(songs)))
+
+        results.append(measure(f"queue.move_range half[{size}]",
+                               lambda queue: queue.move_range(1, size // 2, size + 1),
+                               setup=lambda: make_queue(songs, size // 4)))
+
+        results.append(measure(f"queue.shuffle[{size}]", lambda queue: queue.shuffle(),
+                               setup=lambda: make_queue(songs)))
+
+        queue = make_queue(songs, size // 2)
+        results.append(measure(f"queue.queue_string[{size}]",
+                               lambda _: queue.queue_string(30, 10, 20, 42)))
+
+        # The whole embed, like the queue message shows it
+        bot = SimpleNamespace(loop=loop, get_latest_context=lambda guild: None)
+        guild = SimpleNamespace(id=size, name="benchmark", voice_client=None)
+
+        music = GuildMusic(bot, guild, GuildConfig(config, size), Resolver(1))
+        music.queue.replace(list(songs), size // 2)
+
+        results.append(measure(f"music.make_queue_embed[{size}]", lambda _: music.make_queue_embed()))
+
+        music.renderer.close()
+        music.resolver.shutdown()
+
+    loop.close()
+
+    return results
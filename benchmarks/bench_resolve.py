@@ -0,0 +1,127 @@
+"""
+Looking up songs through a stub extractor, and getting their audio from a
+local HTTP server instead of YouTube.
+"""
+
+import itertools
+import shutil
+import tempfile
+import time
+from typing import Dict, List
+
+from harness import measure, result
+from stubs import AudioServer, StubExtractor, make_wav
+
+
+def run(sizes: List[int]) -> List[Dict]:
+    from config import config
+    import cogs.music.song as song_module
+    from cogs.music.song import Song
+    from cogs.music.audio_cache import AudioCache
+
+    results = []
+
+    with AudioServer(make_wav(30)) as server:
+        extractor = StubExtractor(server, duration=30)
+        song_module.youtube_dl = extractor.module()
+
+        counter = itertools.count()
+
+        config.config["lazy_playlists"] = False
+        results.append(measure("song.from_query miss", lambda _: Song.from_query(f"query {next(counter)}")))
+
+        Song.from_query("the same query")
+        results.append(measure("song.from_query hit", lambda _: Song.from_query("the same query")))
+
+        config.config["lazy_playlists"] = True
+        results.append(measure("song.from_query hit lazy", lambda _: Song.from_query("the same query")))
+
+        for size in sizes:
+            if size > 10000:
+                continue
+
+            extractor.playlist_size = size
+
+            config.config["lazy_playlists"] = True
+            results.append(measure(f"song.from_youtube_url lazy[{size}]",
+                                   lambda _: Song.from_youtube_url("https://www.youtube.com/playlist?list=PL"),
+                                   ops=size))
+
+            config.config["lazy_playlists"] = False
+            results.append(measure(f"song.from_youtube_url full[{size}]",
+                                   lambda _: Song.from_youtube_url("https://www.youtube.com/playlist?list=PL"),
+                                   ops=size))
+
+        results.append(measure("song.resolve",
+                               lambda song: song.resolve(),
+                               setup=lambda: Song("lazy", None, 0, None, "https://www.youtube.com/watch?v=lazy", "lazy")))
+
+        # Downloading to the audio cache from the local server
+        with tempfile.TemporaryDirectory() as directory:
+            config.config["audio_cache_path"] = directory
+            cache = AudioCache(config)
+
+            size_mb = len(server.audio) / 1024 / 1024
+            r = measure("audio_cache.download", lambda video_id: cache._download(video_id, server.url(video_id)),
+                        setup=lambda: f"video-{next(counter)}", max_samples=20)
+            r['mb_per_s'] = size_mb / (r['mean_ms'] / 1000)
+            results.append(r)
+
+            cache.shutdown()
+
+        # How long it takes ffmpeg to give us the first frame of a song
+        if shutil.which("ffmpeg"):
+            import discord
+
+            samples = []
+            for _ in range(10):
+                start = time.perf_counter()
+                source = discord.FFmpegPCMAudio(server.url("first-frame"), options='-vn -loglevel error')
+                source.read()
+                samples.append(time.perf_counter() - start)
+                source.cleanup()
+
+            results.append(result("ffmpeg.first_frame pcm", samples))
+
+    # A long song, to see if seeking gets slower the further in it is
+    if shutil.which("ffmpeg"):
+        with AudioServer(make_wav(600)) as server:
+            results += _seek(server)
+
+    return results
+
+
+def _seek(server: AudioServer) -> List[Dict]:
+    """
+    How long it takes until the first frame after seeking to different
+    positions of a song, seeking on the input and on the output of ffmpeg.
+    """
+
+    from cogs.music.player import MusicPlayer
+    from cogs.music.seekable import seekable_sources
+    from cogs.music.song import Song
+
+    results = []
+
+    duration = len(server.audio) / (48000 * 4)
+    song = Song("seek", server.url("seek"), duration, 48000)
+
+    player = MusicPlayer(None, song, lambda song: {'options': '-vn -loglevel error'}, None, use_opus=False)
+
+    results.append(measure("seekable.check", lambda _: seekable_sources.check(server.url(f"check-{time.time()}")),
+                           max_samples=50))
+
+    for position in (1, duration / 2, duration - 2):
+        for seekable, kind in ((True, "input"), (False, "output")):
+            samples = []
+
+            for _ in range(5):
+                start = time.perf_counter()
+                source = player.make_seek_source(position, seekable=seekable)
+                source.read()
+                samples.append(time.perf_counter() - start)
+                source.cleanup()
+
+            results.append(result(f"player.seek {kind}[{position:.0f} s]", samples))
+
+    return results
@@ -0,0 +1,77 @@
+import json
+import statistics
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+
+def measure(name: str, function: Callable[[Any], Any], setup: Optional[Callable[[], Any]] = None,
+        min_time: float = 0.5, max_samples: int = 1000, ops: int = 1) -> Dict:
+    """
+    Call function repeatedly for at least min_time seconds (but at most
+    max_samples times) and return how long each call took. If setup is given
+    it is called before every call, without being timed, and its result is
+    passed to function. ops is how many operations a single call does, and
+    is only used to report the throughput.
+    """
+
+    samples = []
+    deadline = time.perf_counter() + min_time
+
+    while len(samples) < max_samples and (time.perf_counter() < deadline or len(samples) < 5):
+        argument = setup() if setup else None
+
+        start = time.perf_counter()
+        function(argument)
+        samples.append(time.perf_counter() - start)
+
+    return result(name, samples, ops)
+
+
+def result(name: str, samples: List[float], ops: int = 1) -> Dict:
+    samples = sorted(samples)
+    mean = statistics.fmean(samples)
+
+    def percentile(p):
+        return samples[min(len(samples) - 1, int(p / 100 * len(samples)))]
+
+    return {
+        'name': name,
+        'samples': len(samples),
+        'mean_ms': mean * 1000,
+        'p50_ms': percentile(50) * 1000,
+        'p95_ms': percentile(95) * 1000,
+        'p99_ms': percentile(99) * 1000,
+        'ops_per_s': ops / mean if mean else float('inf'),
+    }
+
+
+def print_results(results: List[Dict], baseline: Optional[Dict[str, Dict]] = None):
+    header = f"{'benchmark':<44} {'samples':>7} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10} {'ops/s':>12}"
+    if baseline:
+        header += f" {'vs base':>8}"
+
+    print(header)
+    print('-' * len(header))
+
+    for r in results:
+        line = (f"{r['name']:<44} {r['samples']:>7} {r['p50_ms']:>10.3f} {r['p95_ms']:>10.3f} "
+                f"{r['p99_ms']:>10.3f} {r['ops_per_s']:>12.1f}")
+
+        if baseline:
+            # Compare the medians, a ratio above 1 means slower than before
+            if (old := baseline.get(r['name'])) and old['p50_ms']:
+                line += f" {r['p50_ms'] / old['p50_ms']:>7.2f}x"
+            else:
+                line += f" {'new':>8}"
+
+        print(line)
+
+
+def save_results(path: str, results: List[Dict]):
+    with open(path, "w", encoding="utf8") as f:
+        f.write(json.dumps(results, indent=4))
+
+
+def load_results(path: str) -> Dict[str, Dict]:
+    with open(path, encoding="utf8") as f:
+        return {r['name']: r for r in json.loads(f.read())}
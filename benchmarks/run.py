@@ -0,0 +1,84 @@
+"""
+Runs the benchmarks without Discord or YouTube. Run it from the root of the
+repository:
+
+    python3 benchmarks/run.py
+    python3 benchmarks/run.py --sizes 10,1000 --only queue --save before.json
+    python3 benchmarks/run.py --compare before.json
+
+Everything the bot writes to disk (config, caches, logs) ends up in a
+temporary directory.
+"""
+
+import argparse
+import os
+from pathlib import Path
+import sys
+import tempfile
+
+ROOT = Path(__file__).resolve().parent.parent
+
+sys.path.insert(0, str(ROOT / "src"))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from harness import load_results, print_results, save_results
+
+SUITES = ["queue", "resolve", "playback"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the hot paths of Stefan")
+    parser.add_argument("--sizes", default="10,100,1000,10000,100000",
+                        help="comma separated queue sizes to benchmark")
+    parser.add_argument("--only", choices=SUITES, action="append",
+                        help="only run the given suite, can be given more than once")
+    parser.add_argument("--save", help="save the results as JSON to this path")
+    parser.add_argument("--compare", help="compare the results to ones saved earlier with --save")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    suites = args.only or SUITES
+
+    save_path = Path(args.save).resolve() if args.save else None
+    baseline = load_results(args.compare) if args.compare else None
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+
+        # Importing the bot reads and writes config.json in the current
+        # directory, so this has to happen after moving to the temporary one
+        import log
+        from config import config
+
+        log.configure("WARNING", {}, 1024 * 1024, 0)
+
+        config.config.update({
+            "resolve_cache_path": ":memory:",
+            "playlists_path": ":memory:",
+            "audio_cache_max_bytes": 0,
+        })
+
+        results = []
+
+        if "queue" in suites:
+            import bench_queue
+            results += bench_queue.run(sizes)
+
+        if "resolve" in suites:
+            import bench_resolve
+            results += bench_resolve.run(sizes)
+
+        if "playback" in suites:
+            import bench_playback
+            results += bench_playback.run(sizes)
+
+        os.chdir(ROOT)
+
+    print_results(results, baseline)
+
+    if save_path:
+        save_results(save_path, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+"""
+Stand-ins for YouTube, so that the resolution and playback paths can be
+measured without network access: an extractor that answers like youtube_dl
+does, and an HTTP server that serves generated audio.
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import math
+import struct
+import threading
+import time
+from types import SimpleNamespace
+from typing import Dict, Optional
+from urllib.parse import parse_qs, urlparse
+import wave
+
+
+def make_wav(seconds: float, sample_rate: int = 48000) -> bytes:
+    """
+    A stereo 16 bit sine wave, so that ffmpeg has something to decode.
+    """
+
+    # A whole number of periods fit in a second, so it can just be repeated
+    second = io.BytesIO()
+    for i in range(sample_rate):
+        sample = int(8000 * math.sin(2 * math.pi * 440 * i / sample_rate))
+        second.write(struct.pack('<hh', sample, sample))
+
+    samples = int(seconds * sample_rate) * 4
+    frames = (second.getvalue() * math.ceil(seconds))[:samples]
+
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as f:
+        f.setnchannels(2)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(frames)
+
+    return buffer.getvalue()
+
+
+class AudioServer:
+    """
+    Serves the same audio file for every path on a random local port,
+    optionally waiting latency seconds before answering like a far away
+    server would. Answers range requests like YouTube does, unless ranges is
+    turned off.
+    """
+
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, audio: bytes, latency: float = 0, ranges: bool = True):
+        self.audio = audio
+        self.latency = latency
+        self.ranges = ranges
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self._respond(body=True)
+
+            def do_HEAD(self):
+                self._respond(body=False)
+
+            def _respond(self, body: bool):
+                time.sleep(server.latency)
+
+                audio = memoryview(server.audio)
+                requested = self.headers.get("Range", "")
+
+                if server.ranges and requested.startswith("bytes="):
+                    start, _, end = requested[len("bytes="):].partition('-')
+                    start, end = int(start), int(end) if end else len(audio) - 1
+
+                    self.send_response(206)
+                    self.send_header("Content-Range", f"bytes {start}-{end}/{len(audio)}")
+                    audio = audio[start:end + 1]
+                else:
+                    self.send_response(200)
+
+                self.send_header("Content-Type", "audio/wav")
+                self.send_header("Content-Length", str(len(audio)))
+                if server.ranges:
+                    self.send_header("Accept-Ranges", "bytes")
+                self.end_headers()
+
+                if body:
+                    try:
+                        # In chunks, so that we stop soon after ffmpeg hangs up
+                        for offset in range(0, len(audio), AudioServer.CHUNK_SIZE):
+                            self.wfile.write(audio[offset:offset + AudioServer.CHUNK_SIZE])
+                    except (BrokenPipeError, ConnectionResetError):
+                        # ffmpeg hangs up as soon as it has what it needs
+                        pass
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def url(self, video_id: str) -> str:
+        # Shaped like the stream urls from YouTube, which carry their expiry
+        expire = int(time.time()) + 6 * 3600
+        return f"http://127.0.0.1:{self._server.server_address[1]}/{video_id}?expire={expire}"
+
+
+class StubExtractor:
+    """
+    Answers extract_info like youtube_dl would for searches, videos and
+    playlists, with every audio source pointing at server. Waits latency
+    seconds per request, to stand in for the time YouTube takes to answer.
+    """
+
+    def __init__(self, server: AudioServer, duration: float, playlist_size: int = 100, latency: float = 0):
+        self.server = server
+        self.duration = duration
+        self.playlist_size = playlist_size
+        self.latency = latency
+
+    def module(self) -> SimpleNamespace:
+        """
+        Something that can be used in place of the youtube_dl module.
+        """
+
+        extractor = self
+
+        class YoutubeDL:
+            def __init__(self, options: Optional[Dict] = None):
+                self.options = options or {}
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                pass
+
+            def extract_info(self, url: str, download: bool = False) -> Dict:
+                return extractor.extract_info(url, self.options)
+
+        return SimpleNamespace(YoutubeDL=YoutubeDL, utils=SimpleNamespace(DownloadError=Exception))
+
+    def video_info(self, video_id: str) -> Dict:
+        return {
+            'id': video_id,
+            'title': f"Video {video_id}",
+            'url': self.server.url(video_id),
+            'webpage_url': f"https://www.youtube.com/watch?v={video_id}",
+            'duration': self.duration,
+            'asr': 48000,
+            'acodec': 'pcm_s16le',
+        }
+
+    def extract_info(self, url: str, options: Dict) -> Dict:
+        time.sleep(self.latency)
+
+        if options.get('default_search') and not url.startswith('http'):
+            return {'entries': [self.video_info(f"search-{abs(hash(url)) % 10**8}")]}
+
+        query = parse_qs(urlparse(url).query)
+
+        if 'list' in query:
+            ids = [f"{query['list'][0]}-{i}" for i in range(self.playlist_size)]
+
+            if options.get('extract_flat'):
+                entries = [{'_type': 'url', 'ie_key': 'Youtube', 'id': video_id, 'url': video_id,
+                            'title': f"Video {video_id}", 'duration': self.duration} for video_id in ids]
+            else:
+                entries = [self.video_info(video_id) for video_id in ids]
+
+            return {'_type': 'playlist', 'entries': entries}
+
+        return self.video_info(query.get('v', ['video'])[0])
@@ -1,7 +1,10 @@
+from typing import List
+
 from discord import Color, Embed
 from discord.ext import commands
 
 from config import config
+from metrics import metrics
 
 class Misc(commands.Cog):
     
@@ -24,7 +27,7 @@ class Misc(commands.Cog):
         """ TODO: Write docstring """
 
         self.command_prefix = new_prefix
-        await self.config.set("prefix", new_prefix)
+        self.config.set("prefix", new_prefix)
 
         await ctx.message.channel.send("Tack för mitt nya prefix! 🥰")
 
@@ -101,5 +104,67 @@ class Misc(commands.Cog):
         embed.add_field(name="**stick / gå / schas / försvinn / dra**", value="Säg åt mig att lämna röstkanalen. 😥", inline=False)
         embed.add_field(name="**kom / hit / komsi komsi / älskling jag är hemma**", value="Be mig att göra dig sällskap! 😇", inline=False)
         embed.add_field(name="**prefix**", value="Ge mig ett nytt prefix som jag kan lyssna på! ☺️")
+        embed.add_field(name="**stats / statistik**", value="Se hur snabb jag är! 🏃", inline=False)
+        await ctx.send(embed=embed)
+
+    @commands.command(name = "stats", aliases = ["statistik"])
+    async def stats(self, ctx):
+        """
+        Show how long commands, lookups and starting songs have taken since
+        the bot started, to see what makes it slow.
+        """
+
+        embed = Embed(title="Statistik 📊", color=Color.orange())
+
+        fields = [
+            ("Kommandon", Misc._latency_lines("stefan_command_seconds")),
+            ("Uppslag", Misc._latency_lines("stefan_resolve_first_song_seconds")),
+            ("youtube-dl", Misc._latency_lines("stefan_youtube_dl_seconds")),
+            ("ffprobe", Misc._latency_lines("stefan_ffprobe_seconds")),
+            ("Väntan på uppslag", Misc._latency_lines("stefan_resolver_wait_seconds")),
+            ("Starta ffmpeg", Misc._latency_lines("stefan_ffmpeg_spawn_seconds")),
+            ("Tid tills låten hörs", Misc._latency_lines("stefan_first_audio_seconds")),
+            ("Eventloopens fördröjning", Misc._latency_lines("stefan_loop_lag_seconds")),
+        ]
+
+        for name, lines in fields:
+            if lines:
+                embed.add_field(name=f"**{name}**", value="```" + '\n'.join(lines) + "```", inline=False)
+
+        queues = metrics.get("stefan_queue_songs").values()
+        requests = metrics.get("stefan_discord_requests_total").values()
+        failed = sum(count for labels, count in requests.items() if dict(labels)["status"] != "ok")
+
+        embed.add_field(name="**Köer**", value=f"{int(sum(queues.values()))} låtar i {len(queues)} servrar")
+        embed.add_field(name="**Discord**", value=f"{int(sum(requests.values()))} anrop, {int(failed)} misslyckade")
+
+        # What has blocked the event loop the most times
+        stalls = sorted(metrics.get("stefan_loop_stalls_total").values().items(), key=lambda item: -item[1])
+        if stalls:
+            lines = [f"{dict(labels)['function']}: {int(count)} ggr" for labels, count in stalls[:5]]
+            embed.add_field(name="**Blockerade eventloopen**", value="```" + '\n'.join(lines) + "```", inline=False)
+
         await ctx.send(embed=embed)
+
+    @staticmethod
+    def _latency_lines(name: str, max_lines: int = 10) -> List[str]:
+        """
+        A line for every label of the histogram name, with how many times it
+        has been observed and its median and 95th percentile, most observed
+        first.
+        """
+
+        histogram = metrics.get(name)
+        lines = []
+
+        for labels in sorted(histogram.label_values(), key=lambda labels: -histogram.count(**dict(labels))):
+            values = dict(labels)
+
+            what = ', '.join(values.values()) or "alla"
+            median = histogram.quantile(0.5, **values) * 1000
+            p95 = histogram.quantile(0.95, **values) * 1000
+
+            lines.append(f"{what}: {histogram.count(**values)} st, median {median:.0f} ms, 95 %: {p95:.0f} ms")
+
+        return lines[:max_lines]
         
\ No newline at end of file
@@ -0,0 +1,185 @@
+from __future__ import annotations
+from concurrent.futures import ThreadPoolExecutor
+import http.client
+import os
+from pathlib import Path
+import shutil
+import threading
+from typing import Callable, List, Optional, Set
+import urllib.request
+
+from log import get_logger
+from config import config
+from .song import Song
+
+logger = get_logger(__name__)
+
+
+class AudioCache:
+    """
+    Keeps local copies of the songs we play, so that replaying them (which we
+    do a lot when looping the queue) doesn't stream them from YouTube again.
+    Songs are downloaded in the background the first time they are played and
+    the least recently played ones are removed when the cache grows larger
+    than audio_cache_max_bytes. Setting that to 0 disables the cache.
+    """
+
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, config):
+        self.config = config
+
+        # Downloading is not urgent, so don't let it compete too much with
+        # everything else for bandwidth
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="audio-cache")
+
+        self._downloading: Set[str] = set()
+        self._lock = threading.Lock()
+
+        # Called with the video id of every song that has been downloaded
+        self._listeners: List[Callable[[str], None]] = []
+
+    def _directory(self) -> Path:
+        return Path(self.config.get("audio_cache_path"))
+
+    def is_enabled(self) -> bool:
+        return self.config.get("audio_cache_max_bytes") > 0
+
+    def has(self, song: Song) -> bool:
+        """
+        Whether we can play song from its local copy. Copies left on disk
+        don't count when the cache is disabled, since they won't be played.
+        """
+
+        return self.is_enabled() and bool(song.video_id) and (self._directory() / song.video_id).exists()
+
+    def path(self, song: Song) -> Optional[Path]:
+        """
+        Get the local copy of song if we have one. Counts as playing it, so
+        that it is the last one to be evicted.
+        """
+
+        if not self.has(song):
+            return None
+
+        path = self._directory() / song.video_id
+
+        try:
+            os.utime(path)
+        except OSError:
+            # It was evicted just now
+            return None
+
+        return path
+
+    def request(self, song: Song):
+        """
+        Start downloading song in the background if we don't have it already.
+        """
+
+        if not self.is_enabled() or not song.video_id or not song.is_resolved() or self.has(song):
+            return
+
+        with self._lock:
+            if song.video_id in self._downloading:
+                return
+
+            self._downloading.add(song.video_id)
+
+        self._executor.submit(self._download, song.video_id, song.source)
+
+    def add_listener(self, listener: Callable[[str], None]):
+        """
+        Call listener with the video id of every song that is downloaded from
+        now on. It is called from the download thread.
+        """
+
+        self._listeners.append(listener)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _download(self, video_id: str, source: str):
+        directory = self._directory()
+        directory.mkdir(parents=True, exist_ok=True)
+
+        path = directory / video_id
+        part_path = directory / f"{video_id}.part"
+        downloaded = False
+
+        try:
+            logger.debug("Downloading '%s' to audio cache", video_id)
+
+            with urllib.request.urlopen(source, timeout=30) as response, open(part_path, "wb") as f:
+                shutil.copyfileobj(response, f, AudioCache.CHUNK_SIZE)
+
+                # Reading in chunks doesn't notice when the server hangs up
+                # early, but then we haven't got all it said it would send
+                if response.length:
+                    raise http.client.IncompleteRead(b'', response.length)
+
+            # Only make it visible once it is complete
+            os.replace(part_path, path)
+            downloaded = True
+
+            self._evict()
+
+        except Exception as e:
+            # Not only OSErrors, like http.client.IncompleteRead or a
+            # ValueError for a source that isn't a url
+            logger.warning(f"Couldn't download '{video_id}' to audio cache", exc_info=e)
+
+        finally:
+            if not downloaded:
+                part_path.unlink(missing_ok=True)
+
+            with self._lock:
+                self._downloading.discard(video_id)
+
+        if not downloaded:
+            return
+
+        for listener in self._listeners:
+            listener(video_id)
+
+    def _evict(self):
+        """
+        Remove the least recently played songs until the cache fits within
+        audio_cache_max_bytes again. Partial downloads count as well, and the
+        ones that aren't being downloaded anymore (left behind when the bot
+        was killed in the middle of one) are removed.
+        """
+
+        with self._lock:
+            downloading = {f"{video_id}.part" for video_id in self._downloading}
+
+        files = []
+        size = 0
+
+        for path in self._directory().iterdir():
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+
+            if path.suffix != ".part":
+                files.append((path, stat))
+            elif path.name not in downloading:
+                logger.debug("Removing partial download '%s' from audio cache", path.name)
+                path.unlink(missing_ok=True)
+                continue
+
+            size += stat.st_size
+
+        max_size = self.config.get("audio_cache_max_bytes")
+
+        for path, stat in sorted(files, key=lambda entry: entry[1].st_mtime):
+            if size <= max_size:
+                break
+
+            logger.debug("Evicting '%s' from audio cache", path.name)
+            path.unlink(missing_ok=True)
+            size -= stat.st_size
+
+
+audio_cache = AudioCache(config)
@@ -0,0 +1,608 @@
+import asyncio
+import time
+from typing import Any, Callable, List, Optional, Set
+
+import discord
+from discord import Color, Embed
+
+from log import get_logger
+from config import GuildConfig
+from metrics import metrics
+from .song_queue import SongQueue
+from .song import Song
+from .audio_cache import audio_cache
+from .loudness import loudness_analyzer
+from .playlist_store import playlist_store
+from .player import MusicPlayer
+from .prefetch import Prefetcher
+from .render import RenderScheduler
+from .resolver import Resolver, ResolveJob
+from .seekable import seekable_sources
+
+logger = get_logger(__name__)
+
+queue_songs = metrics.gauge("stefan_queue_songs", "How many songs are in the queue of each guild", ["guild"])
+
+
+class GuildMusic:
+    """
+    Everything the music cog keeps track of for a single guild: its queue,
+    player, queue message and config overrides. Created when a guild first
+    uses a music command and torn down when the bot disconnects from it.
+    """
+
+    _FFMPEG_COMMON_OPTIONS = {
+        'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5',
+    }
+
+    # How many dB a song's loudness can differ from the target without us
+    # adjusting its volume
+    _LOUDNESS_TOLERANCE = 0.5
+
+    # The peak level (about -1 dBFS) that songs made louder are limited to,
+    # which leaves some headroom for the Opus encoder
+    _LIMITER_LEVEL = 0.89
+
+    # The config values that change what the queue message shows or which
+    # song is prefetched and how, so we only update when one of them changes
+    CONFIG_KEYS = {
+        "title_max_length",
+        "before_current",
+        "after_current",
+        "is_looping_queue",
+        "is_looping_song",
+        "nightcore",
+        "nightcore_tempo",
+        "nightcore_pitch",
+        "loudness_target",
+        "prefetch_time",
+    }
+
+    def __init__(self, bot, guild: discord.Guild, config: GuildConfig, resolver: Resolver):
+        self.bot = bot
+        self.guild = guild
+
+        self.config = config
+        self.config.subscribe(self.on_update, GuildMusic.CONFIG_KEYS)
+
+        self.queue = SongQueue(config)
+        self.queue.subscribe(self.on_update)
+
+        self.queue_message = None
+        self.queue_message_threshold_count = 0
+        self.queue_message_lock = asyncio.Lock()
+
+        # The embed the queue message shows right now, so that we don't edit
+        # it when nothing has changed
+        self._rendered_embed: Optional[dict] = None
+
+        self.renderer = RenderScheduler(bot.loop, self.queue_message_update,
+                                        lambda: self.queue_message is not None and self.is_playing(),
+                                        config.get("render_delay"), config.get("update_interval"))
+
+        self._music_player: Optional[MusicPlayer] = None
+
+        # Set when we want to play an entry that is still being resolved, so
+        # that we start playing as soon as its first song arrives
+        self._waiting_for_song = False
+
+        # When the song we are about to play was asked for, so that we can
+        # measure how long it takes until it is heard
+        self._requested_at: Optional[float] = None
+
+        # How many songs in a row we have had to skip because we couldn't get
+        # their audio source, so that we don't loop over them forever
+        self._failed_in_a_row = 0
+
+        # The resolver is shared between guilds, so keep track of our own jobs
+        self.resolver = resolver
+        self.jobs: List[ResolveJob] = []
+
+        self.prefetcher = Prefetcher(self.resolver, config.get("prefetch_frames"))
+
+        # The songs (by id) we are currently looking up new sources for
+        self._refreshing: Set[int] = set()
+        self._prefetch_timer: Optional[asyncio.TimerHandle] = None
+
+    def on_update(self):
+        queue_songs.set(self.queue.num_songs(), guild=self.guild.id)
+
+        self.renderer.schedule()
+        self.bot.loop.call_soon_threadsafe(self.update_prefetch)
+
+    async def queue_message_delete(self):
+        async with self.queue_message_lock:
+            if self.queue_message:
+                await self.queue_message.delete()
+                self.queue_message = None
+                self._rendered_embed = None
+
+    async def queue_message_send(self, ctx=None):
+        """
+        Send a new queue message in the channel of ctx, or where we were last
+        used if not given.
+        """
+
+        async with self.queue_message_lock:
+            if (ctx := ctx or self.bot.get_latest_context(self.guild)):
+                await ctx.typing()
+
+                embed = self.make_queue_embed()
+                self.queue_message = await ctx.send(embed=embed)
+                self._rendered_embed = embed.to_dict()
+
+        # Start ticking the elapsed time if we are playing
+        self.renderer.schedule()
+
+    async def queue_message_update(self):
+        async with self.queue_message_lock:
+            if not self.queue_message:
+                return
+
+            embed = self.make_queue_embed()
+
+            if embed.to_dict() == self._rendered_embed:
+                return
+
+            await self.queue_message.edit(content=None, embed=embed)
+            self._rendered_embed = embed.to_dict()
+
+    async def close(self):
+        self.cancel_jobs()
+        self.stop()
+        self._music_player = None
+        self.config.close()
+        self.renderer.close()
+        queue_songs.remove(guild=self.guild.id)
+
+        await self.queue_message_delete()
+
+    def ffmpeg_options(self, song: Song):
+
+        filter_options_list = []
+
+        if song.loudness is None:
+            # We don't know how loud the song is yet, so normalize it live
+            filter_options_list.append(f'loudnorm')
+        else:
+            gain = self.config.get("loudness_target") - song.loudness
+
+            # Songs that are already close enough don't need a filter, which
+            # lets us pass on their Opus packets as they are
+            if abs(gain) > GuildMusic._LOUDNESS_TOLERANCE:
+                filter_options_list.append(f'volume={gain:.2f}dB')
+
+            # Making a song louder can push its peaks above full scale, which
+            # would clip. The limiter's auto level would undo the gain.
+            if gain > GuildMusic._LOUDNESS_TOLERANCE:
+                filter_options_list.append(f'alimiter=limit={GuildMusic._LIMITER_LEVEL}:level=disabled')
+
+        if self.config.get('nightcore'):
+            tempo = self.config.get("nightcore_tempo")
+            pitch = self.config.get("nightcore_pitch")
+            freq = song.sample_rate
+
+            filter_options_list.append(f'atempo={tempo}')
+            filter_options_list.append(f'asetrate={freq}*{pitch}')
+
+        option_str = '-vn'  # No video
+
+        if filter_options_list:
+            # Include additional audio filters
+            option_str = option_str + ' -af ' + ','.join(filter_options_list)
+
+        return {
+            **GuildMusic._FFMPEG_COMMON_OPTIONS,
+            'options': option_str,
+        }
+
+    def time_scale(self):
+        return self.nightcore_time_scale() if self.config.get("nightcore") else 1
+
+    def make_queue_embed(self):
+        description = self.queue.queue_string(self.config.get("title_max_length"), self.config.get("before_current"),
+                                                 self.config.get("after_current"), self.elapsed_time(),
+                                                 self.time_scale())
+
+        playing = "✓" if self.is_playing() else "✗"
+
+        nightcore = "✓" if self.config.get("nightcore") else "✗"
+
+        looped = "kö"
+        if self.config.get("is_looping_song"):
+            looping = "✓"
+            looped = "låt"
+        else:
+            looping = "✓" if self.config.get("is_looping_queue") else "✗"
+
+        time = self.queue.duration(self.time_scale())
+
+        info = f"Spelar: {playing}⠀Loopar {looped}: {looping}⠀Nightcore: {nightcore}⠀Antal låtar: {self.queue.num_songs()}⠀Längd: {time}\n"
+
+        description = info + description
+
+        return Embed(color=Color.orange(), title=f"Nuvarande kö 😙", description=description)
+
+    def nightcore_time_scale(self):
+        # Using asetrate in ffmpeg apparently changes the duration of song as
+        # well, so we need to multiply these.
+        return self.config.get("nightcore_tempo") * self.config.get("nightcore_pitch")
+
+    def ensure_player(self):
+        """
+        Create the music player if we don't have one and are connected to a
+        voice channel in this guild. It doesn't get a song until play() has
+        one that is ready, since the current one might still be a resolve job.
+        """
+
+        if not self._music_player and (vc := self.guild.voice_client):
+            self._music_player = MusicPlayer(vc, None, self.ffmpeg_options, self.play_next,
+                                             self.config.get("opus_playback"), self.config.get("opus_bitrate"))
+
+    def remove_player(self):
+        self.stop()
+        self._music_player = None
+
+    def play_next(self, e):
+        if e:
+            logger.error(f"Something went wrong in play_next()", exc_info=e)
+            return
+
+        if self.queue.get_current_index() == self.queue.num_songs() and not (
+                self.config.get("is_looping_queue") or self.config.get("is_looping_song")):
+            self.stop()
+        elif not self.is_stopped():
+            if not self.config.get("is_looping_song"):
+                self.queue.next()
+
+            self.play(self.queue.current_song(), force_start=False)
+
+    def upcoming_song(self) -> Optional[Song]:
+        """
+        The song that will be played when the current one ends, if any.
+        """
+
+        if self.queue.num_songs() == 0:
+            return None
+
+        if self.config.get("is_looping_song"):
+            upcoming = self.queue.current_song()
+        elif self.queue.get_current_index() < self.queue.num_songs():
+            upcoming = self.queue.get_queue()[self.queue.current + 1]
+        elif self.config.get("is_looping_queue"):
+            upcoming = self.queue.get_queue()[0]
+        else:
+            return None
+
+        return None if self.queue.is_pending(upcoming) else upcoming
+
+    def update_prefetch(self):
+        """
+        Throw away the prefetched song if it isn't the upcoming one anymore and
+        schedule prefetching of the upcoming song to prefetch_time seconds
+        before the current song ends. Must be called on the event loop.
+        """
+
+        upcoming = self.upcoming_song()
+
+        options = self.ffmpeg_options(upcoming) if upcoming and upcoming.is_resolved() else None
+        self.prefetcher.discard_unless(upcoming, options)
+
+        if self._prefetch_timer:
+            self._prefetch_timer.cancel()
+            self._prefetch_timer = None
+
+        if upcoming and self.is_playing():
+            remaining = self._music_player.remaining_time(self.time_scale())
+            delay = max(0, remaining - self.config.get("prefetch_time"))
+
+            self._prefetch_timer = self.bot.loop.call_later(delay, self.prefetch_upcoming)
+
+    def prefetch_upcoming(self):
+        self._prefetch_timer = None
+
+        upcoming = self.upcoming_song()
+
+        if upcoming and self._music_player and self.is_playing():
+            loudness_analyzer.request(upcoming)
+
+            if self.needs_refresh(upcoming):
+                # Refreshing it updates the queue, which schedules the
+                # prefetch again
+                if upcoming.can_resolve() and id(upcoming) not in self._refreshing:
+                    self.refresh(upcoming)
+                return
+
+            self.prefetcher.prefetch(upcoming, self.ffmpeg_options, self._music_player.make_source)
+
+    def needs_refresh(self, song: Song) -> bool:
+        """
+        Whether song is missing a source or its source will have expired by
+        the time it has been played, and we don't have it locally either.
+        """
+
+        return not song.is_resolved() or (song.is_stale() and not audio_cache.has(song))
+
+    def refresh(self, song: Song, callback: Optional[Callable[[bool], Any]] = None):
+        """
+        Look up a new audio source for song in the background. callback is
+        called on the event loop with whether it succeeded, which it always
+        is, even if the lookup raises.
+        """
+
+        self._refreshing.add(id(song))
+        previous_source = song.source
+
+        def resolve():
+            try:
+                return song.resolve()
+            except Exception as e:
+                logger.error(f"Something went wrong when refreshing '{song.title}'", exc_info=e)
+                return False
+
+        def on_resolved(success):
+            try:
+                if success:
+                    self.on_song_refreshed(song, previous_source)
+            finally:
+                # Otherwise refresh_ahead would skip the song from now on
+                self._refreshing.discard(id(song))
+
+            if callback:
+                callback(success)
+
+        try:
+            self.resolver.call(resolve, on_resolved)
+        except RuntimeError:
+            # The resolver has been shut down, so nothing will call us back
+            self._refreshing.discard(id(song))
+            raise
+
+    def on_song_refreshed(self, song: Song, previous_source: Optional[str] = None):
+        self.queue.update(song)
+
+        # Save the new source in every playlist the song is in, without
+        # blocking the event loop
+        self.resolver.call(lambda: playlist_store.update_song(song.to_json(), previous_source))
+
+    def refresh_ahead(self):
+        """
+        Refresh the songs right after the current one that are missing a
+        source or whose source will expire before they are played, so that
+        they are ready by the time we get to them. Must be called on the
+        event loop.
+        """
+
+        queue = self.queue.get_queue()
+
+        # The current song is refreshed by play() when it needs to be
+        for offset in range(1, min(self.config.get("refresh_ahead") + 1, len(queue))):
+            song = queue[(self.queue.current + offset) % len(queue)]
+
+            if self.queue.is_pending(song) or not song.can_resolve() or id(song) in self._refreshing:
+                continue
+
+            if self.needs_refresh(song):
+                self.refresh(song)
+
+    # ===============================
+    # ======== Resolve jobs =========
+    # ===============================
+
+    def submit(self, job: ResolveJob):
+        self.queue.add_song(job)
+        self.jobs.append(job)
+        self.resolver.submit(job, self.on_song_resolved, self.on_job_finished)
+
+    def on_song_resolved(self, job: ResolveJob, song: Song):
+        waiting = self._waiting_for_song and self.queue.current_song() is job
+
+        self.queue.insert_before(job, song)
+
+        if waiting:
+            self.play(self.queue.current_song())
+
+    def on_job_finished(self, job: ResolveJob):
+        if job in self.jobs:
+            self.jobs.remove(job)
+
+        if job not in self.queue.get_queue():
+            return
+
+        waiting = self._waiting_for_song and self.queue.current_song() is job
+        was_last = self.queue.get_queue()[-1] is job
+
+        self.queue.remove_entry(job)
+
+        if not waiting:
+            return
+
+        # The job we were waiting for didn't give us any more songs, so just
+        # continue with whatever comes after it
+        if self.queue.num_songs() == 0:
+            self.stop()
+        elif was_last and not self.config.get("is_looping_queue"):
+            self.stop()
+        else:
+            if was_last:
+                self.queue.current = 0
+            self.play(self.queue.current_song())
+
+    def cancel_jobs(self):
+        for job in list(self.jobs):
+            self.resolver.cancel(job)
+            self.on_job_finished(job)
+
+    def cancel_removed_jobs(self):
+        """
+        Cancel every resolve job whose placeholder is no longer in the queue.
+        """
+
+        for job in list(self.jobs):
+            if job not in self.queue.get_queue():
+                self.resolver.cancel(job)
+
+    # =================================================
+    # ========== Wrappers around MusicPlayer ==========
+    # =================================================
+
+    def is_playing(self):
+        if self._music_player:
+            return self._music_player.is_playing()
+        return False
+
+    def is_paused(self):
+        if self._music_player:
+            return self._music_player.is_paused()
+        return False
+
+    def is_stopped(self):
+        if self._music_player:
+            return self._music_player.is_stopped()
+        return True
+
+    def play(self, song=None, force_start=True, ignore_pause=True):
+        if self._music_player and self.queue.num_songs():
+            # The player's song might have been removed from the queue since
+            next_song = song if song else self.queue.current_song()
+
+            # Resuming a paused song keeps using the ffmpeg process we already
+            # have, otherwise we need an audio source that is still valid
+            resuming = self.is_paused() and not ignore_pause and next_song is self._music_player.song
+
+            if not resuming and self._requested_at is None:
+                self._requested_at = time.perf_counter()
+
+            if self.queue.is_pending(next_song):
+                # Start playing once the resolve job gives us its first song
+                self._waiting_for_song = True
+                return
+
+            # We don't need a valid source when we have the song locally
+            needs_source = not (resuming or audio_cache.has(next_song))
+
+            if not next_song.is_resolved() or (next_song.is_stale() and needs_source):
+                self.resolve_and_play(next_song, force_start, ignore_pause)
+                return
+
+            # Use the prefetched source if we have one for this song
+            source = None if resuming else self.prefetcher.take(next_song, self.ffmpeg_options(next_song))
+
+            self._waiting_for_song = False
+            self._failed_in_a_row = 0
+
+            requested_at, self._requested_at = self._requested_at, None
+            self._music_player.play(next_song, force_start, ignore_pause, source, requested_at)
+
+            audio_cache.request(next_song)
+            loudness_analyzer.request(next_song)
+            self.check_seekable(next_song)
+
+            # This might be called from the voice client's thread
+            self.bot.loop.call_soon_threadsafe(self.update_prefetch)
+            self.bot.loop.call_soon_threadsafe(self.refresh_ahead)
+            self.renderer.schedule()
+
+    def resolve_and_play(self, song, force_start=True, ignore_pause=True):
+        """
+        Look up the audio source of a lazily added song (or refresh an expired
+        one) in the background and start playing it when we have it, unless
+        we've moved on since then.
+        """
+
+        self._waiting_for_song = True
+
+        def on_resolved(success):
+            if not self._waiting_for_song or not self.queue.num_songs() or self.queue.current_song() is not song:
+                return
+
+            if success:
+                self.play(song, force_start, ignore_pause)
+                return
+
+            self._waiting_for_song = False
+            self._failed_in_a_row += 1
+
+            # When looping, play_next comes back to the same songs, so give up
+            # once every song we would loop over has failed
+            loop_length = 1 if self.config.get("is_looping_song") else self.queue.num_songs()
+
+            if self._failed_in_a_row >= loop_length:
+                logger.warning(f"Stopping, couldn't get the audio source of the last {self._failed_in_a_row} songs")
+                self.stop()
+            elif self.queue.get_current_index() == self.queue.num_songs() and not self.config.get("is_looping_queue"):
+                logger.warning(f"Stopping, couldn't get the audio source of '{song.title}', the last song")
+                self.stop()
+            else:
+                # Not through play_next, which does nothing when the failed
+                # song was the first one and the player never started
+                logger.warning(f"Skipping '{song.title}', couldn't get its audio source")
+                self.queue.next()
+                self.play(self.queue.current_song(), force_start, ignore_pause)
+
+        self.refresh(song, on_resolved)
+
+    def check_seekable(self, song: Song):
+        """
+        Find out in the background if we can seek in the source of song, so
+        that we know it by the time someone wants to.
+        """
+
+        if song.source and not audio_cache.has(song):
+            seekable_sources.request(song.source)
+
+    def seek(self, seek_time):
+        if not self._music_player:
+            return
+
+        song = self._music_player.song
+
+        # Nothing has been played yet, like while the first song is resolved
+        if not song:
+            return
+
+        if song.is_resolved() and song.is_stale() and not audio_cache.has(song):
+            # Seeking starts a new ffmpeg process, so refresh the source first
+            def on_resolved(success):
+                if success:
+                    self._seek(song, seek_time)
+
+            self.refresh(song, on_resolved)
+        else:
+            self._seek(song, seek_time)
+
+    def _seek(self, song: Song, seek_time):
+        if not self._music_player or self._music_player.song is not song:
+            return
+
+        # Seeking in the input is a lot faster, and ffmpeg still manages when
+        # the server doesn't support it, so only avoid it when we know that
+        seekable = audio_cache.has(song) or seekable_sources.get(song.source) is not False
+
+        self._music_player.seek(seek_time, self.time_scale(), seekable)
+
+        self.update_prefetch()
+        self.renderer.schedule()
+
+    def pause(self):
+        if self._music_player:
+            self._music_player.pause()
+
+        self.update_prefetch()
+        self.renderer.schedule()
+
+    def stop(self):
+        self._waiting_for_song = False
+        self._requested_at = None
+        self._failed_in_a_row = 0
+        self.prefetcher.discard()
+
+        if self._music_player:
+            self._music_player.stop()
+
+        self.renderer.schedule()
+
+    def elapsed_time(self):
+        if self._music_player:
+            return self._music_player.elapsed_time()
+        return 0
@@ -0,0 +1,146 @@
+from __future__ import annotations
+from concurrent.futures import ThreadPoolExecutor
+import json
+import subprocess
+import threading
+from typing import Dict, Optional, Set
+
+from log import get_logger
+from config import config
+from .audio_cache import audio_cache
+from .resolve_cache import resolve_cache
+from .song import Song
+
+logger = get_logger(__name__)
+
+
+class LoudnessAnalyzer:
+    """
+    Measures the integrated loudness of songs in the background, so that they
+    can be normalized with a cheap static gain instead of running loudnorm
+    live while they play. Every video only has to be measured once, since the
+    results are kept in the resolve cache. Songs are measured from their copy
+    in the audio cache, so that they aren't streamed again just for this,
+    which means they wait until they have been downloaded. Only when the
+    audio cache is disabled are they streamed for it.
+    """
+
+    # How many songs can wait for their download before we forget the oldest,
+    # since downloads that fail never get to them
+    MAX_WAITING = 256
+
+    def __init__(self, config):
+        self.config = config
+
+        # Analyzing decodes the whole song, so only do one at a time
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="loudness")
+
+        self._analyzing: Set[str] = set()
+
+        # The songs waiting for their copy in the audio cache, by video id
+        self._waiting: Dict[str, Song] = {}
+        self._lock = threading.Lock()
+
+        audio_cache.add_listener(self._on_cached)
+
+    def request(self, song: Song):
+        """
+        Make sure song gets its loudness, either from the cache or by
+        analyzing it in the background.
+        """
+
+        if song.loudness is not None or not song.video_id:
+            return
+
+        with self._lock:
+            if song.video_id in self._analyzing:
+                return
+
+            self._analyzing.add(song.video_id)
+
+        self._executor.submit(self._analyze, song)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _on_cached(self, video_id: str):
+        with self._lock:
+            song = self._waiting.pop(video_id, None)
+
+        if song:
+            self.request(song)
+
+    def _analyze(self, song: Song):
+        try:
+            if (loudness := resolve_cache.get_loudness(song.video_id)) is None:
+                if not (source := self._source(song)):
+                    return
+
+                loudness = self._measure(song, source)
+
+                if loudness is None:
+                    return
+
+                resolve_cache.put_loudness(song.video_id, loudness)
+
+            song.loudness = loudness
+
+        finally:
+            with self._lock:
+                self._analyzing.discard(song.video_id)
+
+    def _source(self, song: Song) -> Optional[str]:
+        """
+        What to analyze song from: its copy in the audio cache, or None after
+        making song wait for it. Without the audio cache there is nothing to
+        wait for, so the song is streamed once more instead.
+        """
+
+        if not audio_cache.is_enabled():
+            return song.source if song.is_resolved() and not song.is_stale() else None
+
+        if (path := audio_cache.path(song)):
+            return str(path)
+
+        with self._lock:
+            self._waiting[song.video_id] = song
+
+            if len(self._waiting) > LoudnessAnalyzer.MAX_WAITING:
+                del self._waiting[next(iter(self._waiting))]
+
+        # It might have been downloaded before it started waiting
+        if (path := audio_cache.path(song)):
+            with self._lock:
+                self._waiting.pop(song.video_id, None)
+
+            return str(path)
+
+        return None
+
+    def _measure(self, song: Song, source: str) -> Optional[float]:
+        logger.debug("Analyzing loudness of '%s'", song.title)
+
+        args = ['ffmpeg', '-nostdin', '-hide_banner', '-i', source, '-vn', '-af', 'loudnorm=print_format=json', '-f', 'null', '-']
+
+        try:
+            result = subprocess.run(args, capture_output=True, text=True, check=True,
+                                    timeout=self.config.get("loudness_analysis_timeout"))
+
+            # loudnorm prints its measurements as the last thing on stderr
+            measurements, _ = json.JSONDecoder().raw_decode(result.stderr[result.stderr.rindex('{'):])
+            loudness = float(measurements['input_i'])
+
+        except (subprocess.SubprocessError, ValueError, KeyError) as e:
+            logger.warning(f"Couldn't analyze loudness of '{song.title}'", exc_info=e)
+            return None
+
+        # Silence has an integrated loudness of -inf, which is of no use to us
+        if loudness == float('-inf'):
+            return None
+
+        logger.debug("Loudness of '%s' is %s LUFS", song.title, loudness)
+
+        return loudness
+
+
+loudness_analyzer = LoudnessAnalyzer(config)
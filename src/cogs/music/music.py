@@ -1,215 +1,119 @@
 import asyncio
-from typing import Optional
+from typing import Dict, Tuple
 
+import discord
 from discord import Color, Embed
 from discord.ext import commands
 
 from log import get_logger
-from .song_queue import SongQueue
+from config import GuildConfig
 from .song import Song
-from .player import MusicPlayer
+from .audio_cache import audio_cache
+from .loudness import loudness_analyzer
+from .playlist_store import playlist_store
+from .seekable import seekable_sources
+from .guild_music import GuildMusic
+from .player import ffmpeg_encodes_opus
+from .resolver import Resolver, ResolveJob
 
 logger = get_logger(__name__)
 
 
 class Music(commands.Cog):
 
-    _FFMPEG_COMMON_OPTIONS = {
-        'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5',
-    }
-
     def __init__(self, bot, config):
         super().__init__()
 
         self.bot = bot
         self.config = config
-        self.config.subscribe(self.on_update)
 
-        self.queue = SongQueue(config)
-        self.queue.subscribe(self.on_update)
-        
-        self.queue_message = None
-        self.queue_message_threshold_count = 0
-        self.queue_message_lock = asyncio.Lock()
+        # The resolver is shared by every guild, everything else is kept
+        # separately for each of them
+        self.resolver = Resolver(config.get("resolve_workers"))
+        self.guilds: Dict[int, GuildMusic] = {}
+
+        # Find out now rather than when the first song starts
+        ffmpeg_encodes_opus()
 
-        self._music_player: Optional[MusicPlayer] = None
+    def guild_music(self, guild: discord.Guild) -> GuildMusic:
+        """
+        Get the music state of guild, creating it the first time the guild
+        uses a music command.
+        """
 
-        asyncio.create_task(self.periodic_update())
+        if guild.id not in self.guilds:
+            logger.debug(f"Creating music state for guild '{guild.name}'")
+            self.guilds[guild.id] = GuildMusic(self.bot, guild, GuildConfig(self.config, guild.id), self.resolver)
+
+        return self.guilds[guild.id]
+
+    async def cog_check(self, ctx):
+        # There is no queue to play from in direct messages
+        return ctx.guild is not None
 
     async def cog_before_invoke(self, ctx):
-        if self.queue_message_threshold_count <= 1:
+        if self.guild_music(ctx.guild).queue_message_threshold_count <= 1:
             await ctx.typing()
     
     async def cog_after_invoke(self, ctx):
-        self.queue_message_threshold_count -= 1
-        if self.queue_message_threshold_count <= 0:
-            self.queue_message_threshold_count = self.config.get('queue_message_threshold')
-            await self.queue_message_delete()
-            await self.queue_message_send()
-
-    def on_update(self):
-        asyncio.ensure_future(self.async_on_update(), loop=self.bot.loop)
-
-    async def async_on_update(self):
-        await self.queue_message_update()
-
-    async def periodic_update(self):
-        while True:
-            await asyncio.sleep(self.config.get("update_interval"))
-            await self.queue_message_update()
-
-    async def queue_message_delete(self):
-        async with self.queue_message_lock:
-            if self.queue_message:
-                await self.queue_message.delete()
-                self.queue_message = None
-
-    async def queue_message_send(self):
-        async with self.queue_message_lock:
-            if self.bot.latest_context:
-                await self.bot.latest_context.typing()
-                self.queue_message = await self.bot.latest_context.send(embed=self.make_queue_embed())
-    
-    async def queue_message_update(self):
-        async with self.queue_message_lock:
-            if self.queue_message:
-                await self.queue_message.edit(content=None, embed=self.make_queue_embed())
-
-    async def close(self):
-        self.stop()
-
-        await self.queue_message_delete()
-
-    def ffmpeg_options(self):
-       
-        filter_options_list = []
-
-        filter_options_list.append(f'loudnorm') 
-
-        if self.config.get('nightcore'):
-            tempo = self.config.get("nightcore_tempo")
-            pitch = self.config.get("nightcore_pitch")
-            freq = self.queue.current_song().sample_rate
-
-            filter_options_list.append(f'atempo={tempo}') 
-            filter_options_list.append(f'asetrate={freq}*{pitch}')
-
-        option_str = '-vn'  # No video
-
-        if filter_options_list:
-            # Include additional audio filters
-            option_str = option_str + ' -af ' + ','.join(filter_options_list)
-
-        return {
-            **Music._FFMPEG_COMMON_OPTIONS,
-            'options': option_str,
-        }
+        music = self.guild_music(ctx.guild)
 
-    def time_scale(self):
-        return self.nightcore_time_scale() if self.config.get("nightcore") else 1
+        music.queue_message_threshold_count -= 1
+        if music.queue_message_threshold_count <= 0:
+            music.queue_message_threshold_count = music.config.get('queue_message_threshold')
+            await music.queue_message_delete()
+            await music.queue_message_send()
 
-    def make_queue_embed(self):
-        description = self.queue.queue_string(self.config.get("title_max_length"), self.config.get("before_current"),
-                                                 self.config.get("after_current"), self.elapsed_time(),
-                                                 self.time_scale())
-
-        playing = "✓" if self.is_playing() else "✗"
-
-        nightcore = "✓" if self.config.get("nightcore") else "✗"
-
-        looped = "kö"
-        if self.config.get("is_looping_song"):
-            looping = "✓"
-            looped = "låt"
-        else:
-            looping = "✓" if self.config.get("is_looping_queue") else "✗"
-
-        time = self.queue.duration(self.time_scale())
-
-        info = f"Spelar: {playing}⠀Loopar {looped}: {looping}⠀Nightcore: {nightcore}⠀Antal låtar: {self.queue.num_songs()}⠀Längd: {time}\n"
-
-        description = info + description
-
-        return Embed(color=Color.orange(), title=f"Nuvarande kö 😙", description=description)
-
-    def nightcore_time_scale(self):
-        # Using asetrate in ffmpeg apparently changes the duration of song as
-        # well, so we need to multiply these.
-        return self.config.get("nightcore_tempo") * self.config.get("nightcore_pitch")
-
-    def play_next(self, e):
-        if e:
-            logger.error(f"Something went wrong in play_next()", exc_info=e)
-            return
-
-        if self.queue.get_current_index() == self.queue.num_songs() and not (
-                self.config.get("is_looping_queue") or self.config.get("is_looping_song")):
-            self.stop()
-        elif not self.is_stopped():
-            if not self.config.get("is_looping_song"):
-                self.queue.next()
+    async def close(self):
+        for music in self.guilds.values():
+            await music.close()
 
-            self.play(self.queue.current_song(), force_start=False)
+        self.resolver.shutdown()
+        audio_cache.shutdown()
+        loudness_analyzer.shutdown()
+        seekable_sources.shutdown()
+        playlist_store.close()
 
 
     # ============================
     # ===== Stefan functions =====
     # ============================
 
-    def stefan_on_disconnect(self):
-        self.stop()
-        self._music_player = None
-        asyncio.run_coroutine_threadsafe(
-            self.queue_message_delete(), 
-            self.bot.loop)
-
-
-    # =================================================
-    # ========== Wrappers around MusicPlayer ==========
-    # =================================================
-
-    def is_playing(self):
-        if self._music_player:
-            return self._music_player.is_playing()
-        return False
-
-    def is_paused(self):
-        if self._music_player:
-            return self._music_player.is_paused()
-        return False
-
-    def is_stopped(self):
-        if self._music_player:
-            return self._music_player.is_stopped()
-        return True
-
-    def play(self, song=None, force_start=True, ignore_pause=True):
-        if self._music_player:
-            self._music_player.play(song, force_start, ignore_pause)
-
-    def stop(self):
-        if self._music_player:
-            self._music_player.stop()
-
-    def elapsed_time(self):
-        if self._music_player:
-            return self._music_player.elapsed_time()
-        return 0
+    def stefan_on_disconnect(self, guild: discord.Guild):
+        # Tear down everything we kept for the guild, it is created again the
+        # next time the guild uses a music command
+        if (music := self.guilds.pop(guild.id, None)):
+            logger.debug(f"Removing music state for guild '{guild.name}'")
+            asyncio.run_coroutine_threadsafe(
+                music.close(), 
+                self.bot.loop)
 
 
     # ==============================
     # ========== Commands ==========
     # ==============================
 
+    @commands.command(name="cancel", aliases=["avbryt"])
+    async def _cancel(self, ctx):
+        """
+        Cancel every song that is still being looked up.
+        """
+
+        music = self.guild_music(ctx.guild)
+
+        music.cancel_jobs()
+
     @commands.command(name="clear", aliases=["töm", "rensa"])
     async def _clear(self, ctx):
         """
         Remove all songs in the queue.
         """
 
-        self.stop()
-        self._music_player = None
-        self.queue.clear()
+        music = self.guild_music(ctx.guild)
+
+        music.remove_player()
+        music.cancel_jobs()
+        music.queue.clear()
 
     @commands.command(name="load", aliases=["ladda"])
     async def _load(self, ctx, name):
@@ -217,16 +121,20 @@ class Music(commands.Cog):
         Load a previously saved playlist given its name.
         """
 
-        success = self.queue.load(name)
+        music = self.guild_music(ctx.guild)
+
+        success = music.queue.load(name)
 
         if success:
-            await self.bot.join_channel()
+            await self.bot.join_channel(ctx)
+
+            music.ensure_player()
 
-            if not self._music_player and (vc := self.bot.get_voice_client(ctx)):
-                self._music_player = MusicPlayer(vc, self.queue.current_song(), self.ffmpeg_options(), self.play_next)
+            if not music.is_playing():
+                music.play()
 
-            if not self.is_playing():
-                self.play()
+            # Get the songs after the current one ready while it starts
+            music.refresh_ahead()
 
     @commands.command(name="loop", aliases=["loopa", "snurra"])
     async def _loop(self, ctx, arg1=""):
@@ -234,10 +142,12 @@ class Music(commands.Cog):
         Toggles looping of queue or song.
         """
 
+        music = self.guild_music(ctx.guild)
+
         if arg1 in ["sång", "låt", "stycke"]:
-            self.config.toggle('is_looping_song')
+            music.config.toggle('is_looping_song')
         elif arg1 in ["kö", "lista"]:
-            self.config.toggle('is_looping_queue')
+            music.config.toggle('is_looping_queue')
 
     @commands.command(name="move")
     async def _move(self, ctx, index):
@@ -245,9 +155,32 @@ class Music(commands.Cog):
         Move to a song given its index.
         """
 
-        self.queue.move(int(index))
-        if self.queue.num_songs() > 0:
-            self.play(self.queue.current_song())
+        music = self.guild_music(ctx.guild)
+
+        music.queue.move(int(index))
+        if music.queue.num_songs() > 0:
+            music.play(music.queue.current_song())
+
+    @commands.command(name="shift", aliases=["flytta"])
+    async def _shift(self, ctx, songs, to):
+        """
+        Move a song given its index, or every song between a range given as
+        x:y, so that they come right before the song at the given index.
+        """
+
+        music = self.guild_music(ctx.guild)
+
+        start, end = Music._parse_range(songs)
+        music.queue.move_range(start, end, int(to))
+
+    @staticmethod
+    def _parse_range(arg: str) -> Tuple[int, int]:
+        """
+        Parse an index x or an inclusive range x:y into (x, y).
+        """
+
+        start, _, end = arg.partition(':')
+        return int(start), int(end) if end else int(start)
 
     @commands.command(name="next")
     async def _next(self, ctx):
@@ -255,13 +188,15 @@ class Music(commands.Cog):
         Move to the next song.
         """
 
-        if not (self.queue.get_current_index() == self.queue.num_songs() and not self.config.get("is_looping_queue")):
-            self.queue.next()
+        music = self.guild_music(ctx.guild)
+
+        if not (music.queue.get_current_index() == music.queue.num_songs() and not music.config.get("is_looping_queue")):
+            music.queue.next()
 
-            self.play(self.queue.current_song())
+            music.play(music.queue.current_song())
 
         else:
-            self.stop()
+            music.stop()
 
     @commands.command(name="nightcore")
     async def _nightcore(self, ctx):
@@ -269,18 +204,18 @@ class Music(commands.Cog):
         Toggle nightcore mode, increasing pitch and speed of music.
         """
 
-        self.config.toggle('nightcore')
+        music = self.guild_music(ctx.guild)
 
-        if self.config.get('nightcore'):
+        music.config.toggle('nightcore')
+
+        if music.config.get('nightcore'):
             # If we previously played normally, we need go backward
-            seek_time = self.elapsed_time() / self.nightcore_time_scale()
+            seek_time = music.elapsed_time() / music.nightcore_time_scale()
         else:
             # And if we previously played nightcore, we need to go forward
-            seek_time = self.elapsed_time() * self.nightcore_time_scale()
+            seek_time = music.elapsed_time() * music.nightcore_time_scale()
 
-        if self._music_player:
-            self._music_player.ffmpeg_options = self.ffmpeg_options()
-            self._music_player.seek(seek_time)
+        music.seek(seek_time)
 
     @commands.command(name="pause", aliases=["pausa"])
     async def _pause(self, ctx):
@@ -288,8 +223,9 @@ class Music(commands.Cog):
         Pause the currently playing song at the current time.
         """
 
-        if self._music_player:
-            self._music_player.pause()
+        music = self.guild_music(ctx.guild)
+
+        music.pause()
 
     @commands.command(name="play", aliases=["p"])
     async def _play(self, ctx, *args):
@@ -306,6 +242,13 @@ class Music(commands.Cog):
         searches it on youtube and adds the first result to the queue.
         """
 
+        music = self.guild_music(ctx.guild)
+
+        # The actual lookups are slow, so they are done in the background by
+        # the resolver. Until they are done they are shown as placeholders in
+        # the queue.
+        jobs = []
+
         if len(args) == 0 and ctx.message.attachments:
             logger.debug("Playing song(s) from attached file(s).")
             for attachment in ctx.message.attachments:
@@ -314,33 +257,34 @@ class Music(commands.Cog):
                 if filetype != "audio":
                     continue
 
-                song = Song.from_source_url(attachment.url)
-                SongQueue.add_song(song)
+                jobs.append(ResolveJob(attachment.filename, lambda url=attachment.url: [Song.from_source_url(url)],
+                                       "attachment"))
 
         elif len(args) == 1 and args[0].startswith(('http', 'www')):
             logger.debug("Playing song from url.")
 
-            songs = Song.from_url(args[0])
-            self.queue.add_songs(songs)
+            jobs.append(ResolveJob(args[0], lambda url=args[0]: Song.from_url(url), Song.url_source(args[0])))
 
         elif len(args) >= 1:
             logger.debug("Playing song from YouTube query.")
 
-            song = Song.from_query(' '.join(args))
-            self.queue.add_song(song)
+            query = ' '.join(args)
+            jobs.append(ResolveJob(query, lambda: [Song.from_query(query)], "search"))
 
-        if self.queue.num_songs() == 0:
+        for job in jobs:
+            music.submit(job)
+
+        if music.queue.num_songs() == 0:
             logger.warning("Can't play music, no songs in queue")
             return
 
         if not self.bot.get_voice_client(ctx):
-            await self.bot.join_channel()
+            await self.bot.join_channel(ctx)
 
-        if not self._music_player and (vc := self.bot.get_voice_client(ctx)):
-            self._music_player = MusicPlayer(vc, self.queue.current_song(), self.ffmpeg_options(), self.play_next)
+        music.ensure_player()
 
-        if self.is_stopped() or len(args) == 0:
-            self.play(song=self.queue.current_song(), ignore_pause=False)
+        if music.is_stopped() or len(args) == 0:
+            music.play(song=music.queue.current_song(), ignore_pause=False)
 
     @commands.command(name="playlists", aliases=["spellistor", 'pl'])
     async def _playlists(self, ctx):
@@ -348,10 +292,12 @@ class Music(commands.Cog):
         Lists all the saved playlists.
         """
 
+        music = self.guild_music(ctx.guild)
+
         embed = Embed(title="Spellistor:", color=Color.orange())
-        for name, desc, songs in self.queue.get_playlists():
-            noun = "låt" if len(songs) == 1 else "låtar"
-            embed.add_field(name=f"**{name} ({len(songs)} {noun})**", value=f"{desc}", inline=False)
+        for name, desc, num_songs in music.queue.get_playlists():
+            noun = "låt" if num_songs == 1 else "låtar"
+            embed.add_field(name=f"**{name} ({num_songs} {noun})**", value=f"{desc}", inline=False)
         await ctx.send(embed=embed)
 
     @commands.command(name="previous", aliases=["prev"])
@@ -360,12 +306,14 @@ class Music(commands.Cog):
         Move to the previous song.
         """
 
-        if not (self.queue.get_current_index() == 1 and not self.config.get("is_looping_queue")):
-            self.queue.prev()
-            self.play(self.queue.current_song())
+        music = self.guild_music(ctx.guild)
+
+        if not (music.queue.get_current_index() == 1 and not music.config.get("is_looping_queue")):
+            music.queue.prev()
+            music.play(music.queue.current_song())
 
         else:
-            self.stop()
+            music.stop()
 
     @commands.command(name="queue", aliases=["q", "kö"])
     async def _queue(self, ctx):
@@ -373,12 +321,12 @@ class Music(commands.Cog):
         Shows the current queue, which will continuously update.
         """
 
-        if self.queue_message:
-            await self.queue_message.delete()
+        music = self.guild_music(ctx.guild)
 
-        self.queue_message = await ctx.send(embed=self.make_queue_embed())
+        await music.queue_message_delete()
+        await music.queue_message_send(ctx)
 
-        self.queue_message_threshold_count = self.config.get('queue_message_threshold')
+        music.queue_message_threshold_count = music.config.get('queue_message_threshold')
 
     @commands.command(name="remove")
     async def _remove(self, ctx, *args):
@@ -388,30 +336,24 @@ class Music(commands.Cog):
         Will inclusively remove every song between ranges given as x:y.
         """
 
-        # Expand every 'x:y' entry to x, x+1, ..., y-1, y. Ignore incorrect ranges
-        indexes = []
-        for arg in args:
-            if ':' in arg:
-                start, end = [int(x) for x in arg.split(':')]
-                if start > end:
-                    continue
-                for i in range(start, end + 1):
-                    indexes.append(i)
-            else:
-                indexes.append(int(arg))
+        music = self.guild_music(ctx.guild)
+
+        ranges = [Music._parse_range(arg) for arg in args]
 
-        removed_current_song = self.queue.get_current_index() in indexes
+        current = music.queue.get_current_index()
+        removed_current_song = any(start <= current <= end for start, end in ranges)
 
-        self.queue.remove(index for index in indexes if 1 <= index <= self.queue.num_songs())
+        # Removes them all at once
+        music.queue.remove_ranges(ranges)
+        music.cancel_removed_jobs()
 
-        if self.queue.num_songs() > 0:
+        if music.queue.num_songs() > 0:
 
             if removed_current_song:
-                self.play(self.queue.current_song())
+                music.play(music.queue.current_song())
 
         else:
-            self.stop()
-            self._music_player = None
+            music.remove_player()
 
     @commands.command(name="save", aliases=["spara"])
     async def _save(self, ctx, name, desc=None):
@@ -421,7 +363,9 @@ class Music(commands.Cog):
         Can optionally also take a description of the queue.
         """
 
-        self.queue.save(name, desc)
+        music = self.guild_music(ctx.guild)
+
+        music.queue.save(name, desc)
 
     @commands.command(name="seek", aliases=["sök", "spoola"])
     async def _seek(self, ctx, time):
@@ -429,8 +373,9 @@ class Music(commands.Cog):
         Skip to the given time in the current song.
         """
 
-        if self._music_player:
-            self._music_player.seek(int(time))
+        music = self.guild_music(ctx.guild)
+
+        music.seek(int(time))
 
     @commands.command(name="shuffle", aliases=["slumpa", "skaka", "blanda", "stavmixa"])
     async def _shuffle(self, ctx):
@@ -438,8 +383,10 @@ class Music(commands.Cog):
         Shuffle the current queue.
         """
 
-        self.queue.shuffle()
-        self.play(self.queue.current_song())
+        music = self.guild_music(ctx.guild)
+
+        music.queue.shuffle()
+        music.play(music.queue.current_song())
 
     @commands.command(name="stop", aliases=["stoppa"])
     async def _stop(self, ctx):
@@ -447,4 +394,6 @@ class Music(commands.Cog):
         Stop the current song.
         """
 
-        self.stop()
+        music = self.guild_music(ctx.guild)
+
+        music.stop()
@@ -1,15 +1,106 @@
+from collections import deque
 import datetime as dt
-from typing import Dict, Callable
+import functools
+import subprocess
+import time
+from typing import Dict, Callable, Optional
 
 import discord
-from discord import FFmpegPCMAudio
+from discord import FFmpegOpusAudio, FFmpegPCMAudio
 
+from log import get_logger
+from metrics import metrics
+from .audio_cache import audio_cache
 from .song import Song
 
+logger = get_logger(__name__)
+
+ffmpeg_spawn_seconds = metrics.histogram("stefan_ffmpeg_spawn_seconds", "How long it takes to start ffmpeg",
+                                         ["output"])
+first_audio_seconds = metrics.histogram("stefan_first_audio_seconds",
+                                        "How long from asking for a song to its first audio being sent")
+
+
+@functools.lru_cache(maxsize=None)
+def ffmpeg_encodes_opus() -> bool:
+    """
+    Whether ffmpeg has the libopus encoder. Without it ffmpeg still starts in
+    Opus mode, but exits right away, which would end every song at once.
+    Only checked the first time, which the music cog does at startup.
+    """
+
+    try:
+        result = subprocess.run(['ffmpeg', '-hide_banner', '-encoders'], capture_output=True, text=True, timeout=10)
+    except (OSError, subprocess.SubprocessError) as e:
+        logger.warning("Couldn't check if ffmpeg can encode Opus, playing everything that needs it as PCM", exc_info=e)
+        return False
+
+    if 'libopus' not in result.stdout:
+        logger.warning("ffmpeg has no libopus, playing everything that needs to be encoded as PCM")
+        return False
+
+    return True
+
+
+class BufferedAudio(discord.AudioSource):
+    """
+    Wraps an audio source and lets us read some of it ahead of time, so that it
+    can start playing right away.
+    """
+
+    def __init__(self, source: discord.AudioSource):
+        self._source = source
+        self._buffer = deque()
+
+    def fill(self, frames: int):
+        for _ in range(frames):
+            data = self._source.read()
+            self._buffer.append(data)
+
+            if not data:
+                break
+
+    def read(self) -> bytes:
+        if self._buffer:
+            return self._buffer.popleft()
+        return self._source.read()
+
+    def is_opus(self) -> bool:
+        return self._source.is_opus()
+
+    def cleanup(self):
+        self._buffer.clear()
+        self._source.cleanup()
+
+
+class TimedAudio(discord.AudioSource):
+    """
+    Wraps an audio source and records how long it took from requested_at
+    (a time.perf_counter() timestamp) until its first frame was read.
+    """
+
+    def __init__(self, source: discord.AudioSource, requested_at: float):
+        self._source = source
+        self._requested_at = requested_at
+
+    def read(self) -> bytes:
+        if self._requested_at is not None:
+            first_audio_seconds.observe(time.perf_counter() - self._requested_at)
+            self._requested_at = None
+
+        return self._source.read()
+
+    def is_opus(self) -> bool:
+        return self._source.is_opus()
+
+    def cleanup(self):
+        self._source.cleanup()
+
 
 class MusicPlayer:
 
-    def __init__(self, voice_client: discord.VoiceClient, song: Song, ffmpeg_options: Dict, after: Callable):
+    def __init__(self, voice_client: discord.VoiceClient, song: Optional[Song], ffmpeg_options: Callable[[Song], Dict], after: Callable,
+            use_opus: bool = False, opus_bitrate: int = 128):
         self._vc = voice_client
         self._song = song
         self._after = after
@@ -21,14 +112,69 @@ class MusicPlayer:
 
         self.ffmpeg_options = ffmpeg_options
 
-    def play(self, song: Song = None, force_start: bool = True, ignore_pause: bool = True):
+        # Let ffmpeg give us Opus directly instead of PCM that has to be encoded
+        # by us
+        self.use_opus = use_opus
+        self.opus_bitrate = opus_bitrate
+
+    @property
+    def song(self) -> Optional[Song]:
+        return self._song
+
+    def make_source(self, song: Song, ffmpeg_options: Optional[Dict] = None, start: float = 0) -> discord.AudioSource:
+        """
+        Start ffmpeg for song. If start is given, ffmpeg jumps to that many
+        seconds into the song before reading anything, which only works if
+        the source is seekable.
+        """
+
+        if ffmpeg_options is None:
+            ffmpeg_options = self.ffmpeg_options(song)
+
+        if (path := audio_cache.path(song)):
+            # The reconnect options in before_options only work for streams
+            source, ffmpeg_options = str(path), {'options': ffmpeg_options['options']}
+        else:
+            source = song.source
+
+        if start:
+            before_options = ffmpeg_options.get('before_options', '')
+            ffmpeg_options = {**ffmpeg_options, 'before_options': f"-ss {start:.3f} {before_options}".strip()}
+
+        # When the source is Opus and there are no filters, ffmpeg just passes
+        # on the packets from YouTube without decoding or encoding anything.
+        # Otherwise ffmpeg encodes it, which at least keeps that work out of
+        # our process, but only if it has libopus.
+        passthrough = song.codec == 'opus' and '-af' not in ffmpeg_options['options']
+
+        if self.use_opus and (passthrough or ffmpeg_encodes_opus()):
+            with ffmpeg_spawn_seconds.time(output="opus"):
+                # The codec argument is the codec of the source
+                return FFmpegOpusAudio(source, codec='opus' if passthrough else None, bitrate=self.opus_bitrate,
+                                       **ffmpeg_options)
+
+        with ffmpeg_spawn_seconds.time(output="pcm"):
+            return FFmpegPCMAudio(source, **ffmpeg_options)
+
+    def play(self, song: Song = None, force_start: bool = True, ignore_pause: bool = True,
+            source: Optional[discord.AudioSource] = None, requested_at: Optional[float] = None):
+        """
+        Play song (or the current song). If source is given, it is used as the
+        (already started) audio source for song instead of starting a new one.
+        requested_at is when the song was asked for, to measure how long it
+        takes until it is heard.
+        """
 
         if song:
             self._song = song
 
+        def new_source():
+            new = source if source else self.make_source(self._song)
+            return TimedAudio(new, requested_at) if requested_at is not None else new
+
         if self.is_playing():
             # We can simply just switch the source if we are already playing something
-            self._vc.source = FFmpegPCMAudio(self._song.source, **self.ffmpeg_options)
+            self._vc.source = new_source()
             self._start_time = dt.datetime.now()
             self._is_stopped = False
 
@@ -37,12 +183,18 @@ class MusicPlayer:
             self._start_time = dt.datetime.now() - (self._pause_time - self._start_time)
             self._is_stopped = False
 
+            if source:
+                source.cleanup()
+
         elif not self.is_stopped() or (self.is_stopped() and force_start):
             # But if we are not playing we need to send a new source to the voice client
-            self._vc.play(FFmpegPCMAudio(self._song.source, **self.ffmpeg_options), after=self._after)
+            self._vc.play(new_source(), after=self._after)
             self._start_time = dt.datetime.now()
             self._is_stopped = False
 
+        elif source:
+            source.cleanup()
+
     def pause(self):
 
         if self.is_playing():
@@ -50,16 +202,32 @@ class MusicPlayer:
 
         self._pause_time = dt.datetime.now()
 
-    def seek(self, seek_time: int):
+    def make_seek_source(self, seek_time: float, time_scale: float = 1, seekable: bool = True) -> discord.AudioSource:
+        """
+        Start ffmpeg for the current song at seek_time seconds, as we hear
+        it with time_scale applied.
+        """
 
-        if not self.is_stopped():
-            # When we are playing or paused we just fastforward the current song from the beginning to the desired time
-            
-            ffmpeg_options = self.ffmpeg_options.copy()
-            options = ffmpeg_options['options']
-            ffmpeg_options['options'] = f"{options} -ss {seek_time}"
+        if seekable:
+            # Seeking on the input makes ffmpeg jump straight there, with a
+            # range request for streams or a file offset for cached songs. It
+            # is in the time of the song itself though, before filters like
+            # atempo change how fast it goes.
+            return self.make_source(self._song, start=seek_time * time_scale)
 
-            source = FFmpegPCMAudio(self._song.source, **ffmpeg_options)
+        # Otherwise ffmpeg has to read and decode everything up to seek_time
+        # and throw it away, which takes longer the further in it is
+        ffmpeg_options = self.ffmpeg_options(self._song)
+        options = ffmpeg_options['options']
+        ffmpeg_options['options'] = f"{options} -ss {seek_time}"
+
+        return self.make_source(self._song, ffmpeg_options)
+
+    def seek(self, seek_time: float, time_scale: float = 1, seekable: bool = True):
+
+        if not self.is_stopped():
+            # When we are playing or paused we start a new ffmpeg process at the desired time
+            source = self.make_seek_source(seek_time, time_scale, seekable)
 
             was_paused = self.is_paused()
 
@@ -89,6 +257,9 @@ class MusicPlayer:
     def is_stopped(self):
         return self._is_stopped
 
+    def remaining_time(self, time_scaling: float = 1):
+        return self._song.duration / time_scaling - self.elapsed_time()
+
     def elapsed_time(self):
         if self.is_playing():
             return (dt.datetime.now() - self._start_time).total_seconds()
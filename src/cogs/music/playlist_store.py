@@ -0,0 +1,197 @@
+from __future__ import annotations
+import datetime as dt
+import json
+from pathlib import Path
+import sqlite3
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from log import get_logger
+from config import config
+
+logger = get_logger(__name__)
+
+
+class PlaylistStore:
+    """
+    Keeps the saved playlists in an SQLite database, with one row for every
+    playlist and one for every song in it. Listing the playlists only reads
+    their metadata, and saving one playlist doesn't rewrite the others.
+    Playlists from the old playlists.json file are moved over the first time
+    the database is opened.
+    """
+
+    LEGACY_PATH = "playlists.json"
+
+    TIME_FORMAT = "%Y-%m-%d %H:%M"
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS playlists (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE,
+            description TEXT NOT NULL,
+            created TEXT NOT NULL,
+            updated TEXT NOT NULL,
+            num_songs INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS songs (
+            playlist_id INTEGER NOT NULL REFERENCES playlists (id) ON DELETE CASCADE,
+            position INTEGER NOT NULL,
+            title TEXT NOT NULL,
+            source TEXT,
+            duration REAL NOT NULL,
+            sample_rate INTEGER,
+            url TEXT,
+            video_id TEXT,
+            codec TEXT,
+            loudness REAL,
+            PRIMARY KEY (playlist_id, position)
+        );
+        CREATE INDEX IF NOT EXISTS songs_video_id ON songs (video_id);
+    """
+
+    SONG_COLUMNS = ('title', 'source', 'duration', 'sample_rate', 'url', 'video_id', 'codec', 'loudness')
+
+    def __init__(self, config):
+        self.config = config
+
+        self._connection: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            path = self.config.get("playlists_path")
+            logger.debug(f"Opening playlist store '{path}'")
+
+            # Transactions are handled explicitly, so that every change is
+            # written completely or not at all
+            self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._connection.execute("PRAGMA foreign_keys = ON")
+            self._connection.executescript(PlaylistStore.SCHEMA)
+
+            self._migrate(Path(PlaylistStore.LEGACY_PATH))
+
+        return self._connection
+
+    def _migrate(self, path: Path):
+        """
+        Move the playlists in the old JSON file into the database and rename
+        the file, so that it is only done once.
+        """
+
+        if not path.exists():
+            return
+
+        with open(path, encoding="utf8") as f:
+            playlists = json.loads(f.read())
+
+        logger.info(f"Migrating {len(playlists)} playlists from '{path}' to playlist store")
+
+        with self._connection:
+            self._connection.execute("BEGIN")
+
+            for name, playlist in playlists.items():
+                self._write(name, playlist["description"], playlist["songs"],
+                            playlist.get("created"), playlist.get("updated"))
+
+        path.rename(path.with_name(path.name + ".migrated"))
+
+    def _write(self, name: str, description: Optional[str], songs: List[Dict],
+            created: Optional[str] = None, updated: Optional[str] = None):
+        connection = self._connection
+        now = dt.datetime.now().strftime(PlaylistStore.TIME_FORMAT)
+
+        row = connection.execute("SELECT id, description FROM playlists WHERE name = ?", (name,)).fetchone()
+
+        if row:
+            playlist_id, old_description = row
+            connection.execute(
+                "UPDATE playlists SET description = ?, updated = ?, num_songs = ? WHERE id = ?",
+                (description or old_description, updated or now, len(songs), playlist_id))
+            connection.execute("DELETE FROM songs WHERE playlist_id = ?", (playlist_id,))
+        else:
+            playlist_id = connection.execute(
+                "INSERT INTO playlists (name, description, created, updated, num_songs) VALUES (?, ?, ?, ?, ?)",
+                (name, description or "Ingen beskrivning", created or now, updated or now, len(songs))).lastrowid
+
+        columns = ', '.join(PlaylistStore.SONG_COLUMNS)
+        placeholders = ', '.join('?' for _ in PlaylistStore.SONG_COLUMNS)
+
+        connection.executemany(
+            f"INSERT INTO songs (playlist_id, position, {columns}) VALUES (?, ?, {placeholders})",
+            ((playlist_id, position, *(song.get(column) for column in PlaylistStore.SONG_COLUMNS))
+                for position, song in enumerate(songs)))
+
+    def save(self, name: str, description: Optional[str], songs: List[Dict]):
+        """
+        Save songs (as given by Song.to_json) as the playlist name, replacing
+        its songs if it already exists. The description is only changed if
+        one is given.
+        """
+
+        with self._lock:
+            connection = self._connect()
+
+            with connection:
+                connection.execute("BEGIN")
+                self._write(name, description, songs)
+
+    def load(self, name: str) -> Optional[List[Dict]]:
+        """
+        Get the songs of the playlist name in the format of Song.to_json, or
+        None if there is no such playlist.
+        """
+
+        columns = ', '.join(f"songs.{column}" for column in PlaylistStore.SONG_COLUMNS)
+
+        with self._lock:
+            connection = self._connect()
+
+            if not connection.execute("SELECT 1 FROM playlists WHERE name = ?", (name,)).fetchone():
+                return None
+
+            rows = connection.execute(
+                f"SELECT {columns} FROM songs JOIN playlists ON songs.playlist_id = playlists.id "
+                f"WHERE playlists.name = ? ORDER BY songs.position", (name,)).fetchall()
+
+        return [dict(zip(PlaylistStore.SONG_COLUMNS, row)) for row in rows]
+
+    def update_song(self, song: Dict, previous_source: Optional[str] = None):
+        """
+        Update every saved copy of a song (as given by Song.to_json) after its
+        source has been refreshed, so that the playlists it is in start out
+        with a fresh source the next time they are loaded. Copies saved before
+        we kept the page of songs are found by previous_source, and get the
+        page the song was found at again.
+        """
+
+        if not song.get('video_id'):
+            return
+
+        with self._lock:
+            if previous_source:
+                self._connect().execute(
+                    "UPDATE songs SET url = ?, video_id = ? WHERE video_id IS NULL AND source = ?",
+                    (song['url'], song['video_id'], previous_source))
+
+            self._connect().execute(
+                "UPDATE songs SET source = ?, duration = ?, sample_rate = ?, codec = ? WHERE video_id = ?",
+                (song['source'], song['duration'], song['sample_rate'], song['codec'], song['video_id']))
+
+    def playlists(self) -> List[Tuple[str, str, int]]:
+        """
+        Get the name, description and number of songs of every playlist.
+        """
+
+        with self._lock:
+            return self._connect().execute(
+                "SELECT name, description, num_songs FROM playlists ORDER BY id").fetchall()
+
+    def close(self):
+        with self._lock:
+            if self._connection:
+                self._connection.close()
+                self._connection = None
+
+
+playlist_store = PlaylistStore(config)
@@ -0,0 +1,118 @@
+from __future__ import annotations
+import threading
+from typing import Callable, Dict, Optional
+
+import discord
+
+from log import get_logger
+from .player import BufferedAudio
+from .resolver import Resolver
+from .song import Song
+
+logger = get_logger(__name__)
+
+
+class Prefetcher:
+    """
+    Gets the next song ready while the current one is still playing. An
+    ffmpeg process for the next song is started and buffered ahead of time, so
+    that switching to it when the current song ends doesn't leave a gap. The
+    song must already have a fresh source, refreshing it is up to the caller.
+    """
+
+    def __init__(self, resolver: Resolver, buffered_frames: int):
+        self._resolver = resolver
+        self._buffered_frames = buffered_frames
+
+        self._song: Optional[Song] = None
+        self._ffmpeg_options: Optional[Dict] = None
+        self._source: Optional[BufferedAudio] = None
+
+        # Increased every time the prefetch is discarded, so that we can tell
+        # if a prefetch that finishes is still wanted
+        self._generation = 0
+
+        # The prefetch may be taken from the voice client's thread
+        self._lock = threading.Lock()
+
+    def prefetch(self, song: Song,
+            ffmpeg_options: Callable[[Song], Dict],
+            make_source: Callable[[Song, Dict], discord.AudioSource],
+        ):
+        """
+        Start getting song ready in the background.
+        """
+
+        with self._lock:
+            if self._song is song:
+                return
+
+            self._discard()
+
+            self._song = song
+            generation = self._generation
+
+        def work():
+            options = ffmpeg_options(song)
+
+            source = BufferedAudio(make_source(song, options))
+            source.fill(self._buffered_frames)
+
+            return source, options
+
+        def on_done(result):
+            with self._lock:
+                if generation != self._generation:
+                    # It was discarded while we were busy with it
+                    if result:
+                        result[0].cleanup()
+                    return
+
+                if result:
+                    logger.debug("Prefetched '%s'", song.title)
+                    self._source, self._ffmpeg_options = result
+
+        logger.debug("Prefetching '%s'", song.title)
+        self._resolver.call(work, on_done)
+
+    def take(self, song: Song, ffmpeg_options: Dict) -> Optional[BufferedAudio]:
+        """
+        Get the prefetched source if it is for song and was started with the
+        same options, otherwise None. The prefetch is used up either way.
+        """
+
+        with self._lock:
+            source = self._source
+            matches = self._song is song and self._ffmpeg_options == ffmpeg_options
+
+            if source and matches:
+                self._source = None
+
+            self._discard()
+
+        return source if source and matches else None
+
+    def discard_unless(self, song: Optional[Song], ffmpeg_options: Optional[Dict] = None):
+        """
+        Discard the prefetch unless it is for song and, if given, was started
+        with the same ffmpeg options.
+        """
+
+        with self._lock:
+            if self._song is not song:
+                self._discard()
+            elif ffmpeg_options is not None and self._source and self._ffmpeg_options != ffmpeg_options:
+                self._discard()
+
+    def discard(self):
+        with self._lock:
+            self._discard()
+
+    def _discard(self):
+        if self._source:
+            self._source.cleanup()
+
+        self._song = None
+        self._ffmpeg_options = None
+        self._source = None
+        self._generation += 1
@@ -0,0 +1,88 @@
+from __future__ import annotations
+import asyncio
+from typing import Any, Awaitable, Callable, Optional
+
+import discord
+
+from log import get_logger
+
+logger = get_logger(__name__)
+
+
+class RenderScheduler:
+    """
+    Decides when the queue message is edited. Every change only asks for a
+    render, and all changes that are asked for within delay seconds of each
+    other are rendered with a single edit. While is_live() is true it also
+    renders every interval seconds, so that the elapsed time keeps moving,
+    and stops doing that as soon as it isn't.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop,
+            render: Callable[[], Awaitable[Any]],
+            is_live: Callable[[], bool],
+            delay: float,
+            interval: float,
+        ):
+        self._loop = loop
+        self._render = render
+        self._is_live = is_live
+        self._delay = delay
+        self._interval = interval
+
+        self._pending: Optional[asyncio.TimerHandle] = None
+        self._ticker: Optional[asyncio.TimerHandle] = None
+        self._task: Optional[asyncio.Task] = None
+
+        # Set when a render is asked for while another one is in progress
+        self._dirty = False
+        self._closed = False
+
+    def schedule(self):
+        """
+        Ask for a render. Safe to call from any thread.
+        """
+
+        self._loop.call_soon_threadsafe(self._schedule)
+
+    def close(self):
+        self._closed = True
+
+        for handle in (self._pending, self._ticker):
+            if handle:
+                handle.cancel()
+
+        self._pending = None
+        self._ticker = None
+        self._dirty = False
+
+    def _schedule(self):
+        if self._pending is None and not self._closed:
+            self._pending = self._loop.call_later(self._delay, self._start)
+
+    def _start(self):
+        self._pending = None
+
+        if self._task and not self._task.done():
+            # Don't let edits overtake each other, render again afterwards
+            self._dirty = True
+            return
+
+        self._task = self._loop.create_task(self._run())
+
+    async def _run(self):
+        try:
+            await self._render()
+        except discord.HTTPException as e:
+            logger.warning(f"Couldn't render queue message", exc_info=e)
+
+        if self._dirty:
+            self._dirty = False
+            self._schedule()
+
+        if self._ticker is None and self._is_live():
+            self._ticker = self._loop.call_later(self._interval, self._tick)
+
+    def _tick(self):
+        self._ticker = None
+        self._schedule()
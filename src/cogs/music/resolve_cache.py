@@ -0,0 +1,151 @@
+from __future__ import annotations
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional
+
+from log import get_logger
+from config import config
+
+logger = get_logger(__name__)
+
+
+class ResolveCache:
+    """
+    Remembers which YouTube video a search query or Spotify track resolved to,
+    so that we don't have to search YouTube for it again. Entries expire after
+    resolve_cache_ttl seconds and the least recently used entries are evicted
+    when there are more than resolve_cache_max_entries of them. It also keeps
+    the measured loudness of every video we have analyzed.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS resolved (
+            key TEXT PRIMARY KEY,
+            video_id TEXT NOT NULL,
+            title TEXT NOT NULL,
+            duration REAL,
+            created REAL NOT NULL,
+            last_used REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS resolved_last_used ON resolved (last_used);
+        CREATE TABLE IF NOT EXISTS loudness (
+            video_id TEXT PRIMARY KEY,
+            integrated REAL NOT NULL
+        );
+    """
+
+    def __init__(self, config):
+        self.config = config
+
+        self._connection: Optional[sqlite3.Connection] = None
+        self._size = 0
+
+        # The cache is used from the resolver threads, so only let one of them
+        # use the connection at a time
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            path = self.config.get("resolve_cache_path")
+            logger.debug(f"Opening resolve cache '{path}'")
+
+            self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._connection.executescript(ResolveCache.SCHEMA)
+            self._size = self._connection.execute("SELECT COUNT(*) FROM resolved").fetchone()[0]
+
+        return self._connection
+
+    def get(self, key: str) -> Optional[Dict]:
+        now = time.time()
+
+        with self._lock:
+            connection = self._connect()
+
+            row = connection.execute(
+                "SELECT video_id, title, duration, created FROM resolved WHERE key = ?", (key,)).fetchone()
+
+            if not row:
+                return None
+
+            video_id, title, duration, created = row
+
+            if now - created > self.config.get("resolve_cache_ttl"):
+                connection.execute("DELETE FROM resolved WHERE key = ?", (key,))
+                self._size -= 1
+                return None
+
+            connection.execute("UPDATE resolved SET last_used = ? WHERE key = ?", (now, key))
+
+        logger.debug("Found '%s' in resolve cache", key)
+
+        return {
+            'video_id': video_id,
+            'title': title,
+            'duration': duration,
+        }
+
+    def put(self, key: str, video_id: str, title: str, duration: Optional[float]):
+        now = time.time()
+
+        with self._lock:
+            connection = self._connect()
+
+            exists = connection.execute("SELECT 1 FROM resolved WHERE key = ?", (key,)).fetchone()
+
+            connection.execute(
+                "INSERT OR REPLACE INTO resolved (key, video_id, title, duration, created, last_used) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, video_id, title, duration, now, now))
+
+            if not exists:
+                self._size += 1
+
+            max_entries = self.config.get("resolve_cache_max_entries")
+
+            if self._size > max_entries:
+                connection.execute(
+                    "DELETE FROM resolved WHERE key IN (SELECT key FROM resolved ORDER BY last_used LIMIT ?)",
+                    (self._size - max_entries,))
+                self._size = connection.execute("SELECT COUNT(*) FROM resolved").fetchone()[0]
+
+    def get_loudness(self, video_id: str) -> Optional[float]:
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT integrated FROM loudness WHERE video_id = ?", (video_id,)).fetchone()
+
+        return row[0] if row else None
+
+    def put_loudness(self, video_id: str, integrated: float):
+        """
+        Remember the integrated loudness (in LUFS) of a video. It never changes,
+        so unlike the resolved queries these never expire.
+        """
+
+        with self._lock:
+            self._connect().execute(
+                "INSERT OR REPLACE INTO loudness (video_id, integrated) VALUES (?, ?)", (video_id, integrated))
+
+    def close(self):
+        with self._lock:
+            if self._connection:
+                self._connection.close()
+                self._connection = None
+
+    @staticmethod
+    def query_key(query: str) -> str:
+        """
+        Normalize a search query so that it is found regardless of case and
+        whitespace.
+
+        >>> ResolveCache.query_key("  Never Gonna   give you UP ")
+        "query:never gonna give you up"
+        """
+
+        return "query:" + ' '.join(query.lower().split())
+
+    @staticmethod
+    def spotify_key(track_id: str) -> str:
+        return "spotify:" + track_id
+
+
+resolve_cache = ResolveCache(config)
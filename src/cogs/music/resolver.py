@@ -0,0 +1,177 @@
+from __future__ import annotations
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+from typing import Any, Callable, Dict, Generator, Iterable, List, Optional, Tuple
+
+from log import get_logger
+from metrics import metrics
+from .song import Song
+
+logger = get_logger(__name__)
+
+wait_seconds = metrics.histogram("stefan_resolver_wait_seconds", "How long lookups wait for a free resolver worker")
+first_song_seconds = metrics.histogram("stefan_resolve_first_song_seconds",
+                                       "How long until a lookup gives its first song, by where it is from", ["source"])
+resolve_seconds = metrics.histogram("stefan_resolve_seconds", "How long a whole lookup takes, by where it is from",
+                                    ["source"])
+
+
+class ResolveJob:
+    """
+    A lookup (url, search query or attachment) that is being turned into songs
+    in the background. While it is running it sits in the song queue as a
+    placeholder entry, and every song it produces is inserted right before it
+    so that the order of the queue is kept. source is where the songs come
+    from, like 'youtube', 'spotify', 'search' or 'attachment'.
+    """
+
+    duration: float = 0
+
+    def __init__(self, title: str, resolve: Callable[[], Iterable[Song]], source: str):
+        self.title = title
+        self.resolve = resolve
+        self.source = source
+
+        self.num_resolved = 0
+        self.future = None
+
+        self._cancelled = threading.Event()
+
+    def cancel(self) -> bool:
+        """
+        Stop the job, and return whether it was stopped before it started.
+        """
+
+        self._cancelled.set()
+
+        return self.future.cancel() if self.future else False
+
+    def is_cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def progress_string(self) -> str:
+        return f"hämtar... {self.num_resolved}" if self.num_resolved else "hämtar..."
+
+
+class Resolver:
+    """
+    Runs blocking lookups (youtube-dl, Spotify, ffprobe) in a bounded pool of
+    worker threads. Results are always handed back on the event loop, so the
+    callbacks are free to touch the song queue and the voice client.
+    """
+
+    def __init__(self, max_workers: int):
+        self._loop = asyncio.get_event_loop()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="resolver")
+
+        self.jobs: List[ResolveJob] = []
+
+        # The callbacks for each job, since the resolver is shared by all guilds
+        self._callbacks: Dict[ResolveJob, Tuple[Callable, Callable]] = {}
+
+    def submit(self, job: ResolveJob,
+            on_song: Callable[[ResolveJob, Song], Any],
+            on_finished: Callable[[ResolveJob], Any],
+        ):
+        """
+        Start resolving job. Every song it produces is passed to on_song and
+        on_finished is called when it is done, both on the event loop.
+        """
+
+        logger.debug("Submitting resolve job '%s'", job.title)
+        self.jobs.append(job)
+        self._callbacks[job] = (on_song, on_finished)
+        job.future = self._executor.submit(self._run, job, time.perf_counter())
+
+    def call(self, function: Callable[[], Any], callback: Optional[Callable[[Any], Any]] = None):
+        """
+        Run a single blocking function in the pool and optionally call
+        callback with its result on the event loop.
+        """
+
+        submitted = time.perf_counter()
+
+        def run():
+            wait_seconds.observe(time.perf_counter() - submitted)
+
+            try:
+                result = function()
+            except Exception as e:
+                logger.error("Something went wrong in a resolver call", exc_info=e)
+                return
+
+            if callback:
+                self._loop.call_soon_threadsafe(callback, result)
+
+        return self._executor.submit(run)
+
+    def cancel(self, job: ResolveJob):
+        if job in self.jobs:
+            logger.debug("Cancelling resolve job '%s'", job.title)
+
+            # A job that never started won't finish by itself
+            if job.cancel():
+                self._finish(job)
+
+    def cancel_all(self):
+        for job in list(self.jobs):
+            self.cancel(job)
+
+    def shutdown(self):
+        self.cancel_all()
+        self._executor.shutdown(wait=False)
+
+    def _run(self, job: ResolveJob, submitted: float):
+        start = time.perf_counter()
+        wait_seconds.observe(start - submitted)
+
+        songs = None
+        first = True
+
+        try:
+            songs = job.resolve() or []
+
+            for song in songs:
+                if job.is_cancelled():
+                    break
+
+                # Lookups that don't find anything give us None, skip those
+                if song:
+                    if first:
+                        first_song_seconds.observe(time.perf_counter() - start, source=job.source)
+                        first = False
+
+                    self._loop.call_soon_threadsafe(self._deliver, job, song)
+
+        except Exception as e:
+            logger.error(f"Something went wrong when resolving '{job.title}'", exc_info=e)
+
+        finally:
+            # Stop streaming resolvers from doing any more work for us
+            if isinstance(songs, Generator):
+                songs.close()
+
+            resolve_seconds.observe(time.perf_counter() - start, source=job.source)
+
+            self._loop.call_soon_threadsafe(self._finish, job)
+
+    def _deliver(self, job: ResolveJob, song: Song):
+        if job.is_cancelled():
+            return
+
+        job.num_resolved += 1
+
+        on_song, _ = self._callbacks[job]
+        on_song(job, song)
+
+    def _finish(self, job: ResolveJob):
+        if job in self.jobs:
+            self.jobs.remove(job)
+
+        if not job.num_resolved and not job.is_cancelled():
+            logger.warning(f"Resolve job '{job.title}' didn't find any songs")
+
+        _, on_finished = self._callbacks.pop(job)
+        on_finished(job)
@@ -0,0 +1,96 @@
+from __future__ import annotations
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import threading
+from typing import Optional, Set
+import urllib.request
+
+from log import get_logger
+from config import config
+
+logger = get_logger(__name__)
+
+
+class SeekableSources:
+    """
+    Remembers which audio sources ffmpeg can jump around in, which for streams
+    means that the server answers range requests. Checking takes a request to
+    the server, so it is done on a thread of its own when a song starts
+    playing, where it can't hold up looking up songs. Seeking never waits for
+    it, sources that haven't been checked yet are assumed to be seekable.
+    """
+
+    MAX_ENTRIES = 256
+
+    def __init__(self, config):
+        self.config = config
+
+        self._seekable: OrderedDict[str, bool] = OrderedDict()
+
+        # A check is a single small request, so one thread is plenty
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="seekable")
+
+        self._checking: Set[str] = set()
+        self._lock = threading.Lock()
+
+    def get(self, source: str) -> Optional[bool]:
+        """
+        Whether source is seekable, or None if it hasn't been checked yet.
+        """
+
+        with self._lock:
+            return self._seekable.get(source)
+
+    def request(self, source: str):
+        """
+        Check source in the background if we haven't already.
+        """
+
+        with self._lock:
+            if source in self._seekable or source in self._checking:
+                return
+
+            self._checking.add(source)
+
+        self._executor.submit(self._check, source)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _check(self, source: str):
+        try:
+            self.check(source)
+        finally:
+            with self._lock:
+                self._checking.discard(source)
+
+    def check(self, source: str) -> bool:
+        """
+        Ask the server of source for its first byte and remember whether it
+        gave us just that. This blocks, so use request on the event loop.
+        """
+
+        if (seekable := self.get(source)) is not None:
+            return seekable
+
+        request = urllib.request.Request(source, headers={"Range": "bytes=0-0"})
+
+        try:
+            with urllib.request.urlopen(request, timeout=self.config.get("probe_timeout")) as response:
+                seekable = response.status == 206
+        except Exception as e:
+            # Like unknown url schemes, or http.client errors that aren't
+            # OSErrors
+            logger.debug("Couldn't check if '%s' is seekable", source, exc_info=e)
+            seekable = False
+
+        with self._lock:
+            self._seekable[source] = seekable
+
+            if len(self._seekable) > SeekableSources.MAX_ENTRIES:
+                self._seekable.popitem(last=False)
+
+        return seekable
+
+
+seekable_sources = SeekableSources(config)
@@ -1,24 +1,40 @@
 from __future__ import annotations
+import json
 from pathlib import Path
 import re
-from typing import List, Dict, Optional
-
-import ffmpeg 
-import spotipy
-from spotipy.oauth2 import SpotifyClientCredentials
-import youtube_dl
+import subprocess
+import time
+from typing import Iterator, List, Dict, Optional
+from urllib.parse import parse_qs, urlparse
 
 from log import get_logger
 from config import config
+from metrics import metrics
+from utils import LazyModule, ordered_map
+from .spotify import spotify_client
+from .resolve_cache import ResolveCache, resolve_cache
 
 logger = get_logger(__name__)
 
+# These take a long time to import, and aren't needed until the first song is
+# looked up
+spotipy = LazyModule("spotipy")
+youtube_dl = LazyModule("youtube_dl")
+
+youtube_dl_seconds = metrics.histogram("stefan_youtube_dl_seconds", "How long youtube-dl takes to extract info",
+                                       ["kind"])
+ffprobe_seconds = metrics.histogram("stefan_ffprobe_seconds", "How long ffprobe takes to probe an audio source")
+
 class Song:
 
     title: str
-    source: str
+    source: Optional[str]
     duration: float
-    sample_rate: int
+    sample_rate: Optional[int]
+    url: Optional[str]
+    video_id: Optional[str]
+    codec: Optional[str]
+    loudness: Optional[float]
 
     _COMMON_YDL_OPTIONS = {
         'format': 'bestaudio',
@@ -31,18 +47,36 @@ class Song:
     # A regular expression that includes all characters EXCEPT the alphanumerics.
     TITLE_SANITIZE_RE = re.compile('[^a-zA-Z0-9åäöÅÄÖ]')
 
-    def __init__(self, title: str, source: str, duration: float, sample_rate: int):
+    def __init__(self, title: str, source: Optional[str], duration: float, sample_rate: Optional[int],
+            url: Optional[str] = None, video_id: Optional[str] = None, codec: Optional[str] = None,
+            loudness: Optional[float] = None):
         self.title = title
         self.source = source
         self.duration = duration
         self.sample_rate = sample_rate
 
+        # The page the song came from, which is what we need to look up the
+        # audio source again
+        self.url = url
+        self.video_id = video_id
+
+        # The audio codec of the source, so that we know if we can pass it on
+        # to Discord without re-encoding it
+        self.codec = codec
+
+        # The integrated loudness in LUFS, once it has been analyzed
+        self.loudness = loudness
+
     def to_json(self) -> Dict:
         return {
             'title': self.title,
             'source': self.source,
             'duration': self.duration,
             'sample_rate': self.sample_rate,
+            'url': self.url,
+            'video_id': self.video_id,
+            'codec': self.codec,
+            'loudness': self.loudness,
         }
 
     @staticmethod
@@ -51,11 +85,152 @@ class Song:
         source = json['source']
         duration = json['duration']
         sample_rate = json['sample_rate']
+        url = json.get('url')
+        video_id = json.get('video_id')
+        codec = json.get('codec')
+        loudness = json.get('loudness')
+
+        return Song(title, source, duration, sample_rate, url, video_id, codec, loudness)
+
+    def is_resolved(self) -> bool:
+        return self.source is not None
+
+    def expires(self) -> Optional[float]:
+        """
+        The time (as a unix timestamp) when the audio source stops working, if
+        we know it. The stream urls we get from YouTube carry it in their
+        'expire' parameter.
+        """
+
+        if not self.source:
+            return None
+
+        expire = parse_qs(urlparse(self.source).query).get('expire')
 
-        return Song(title, source, duration, sample_rate)
+        return float(expire[0]) if expire else None
+
+    def is_stale(self) -> bool:
+        """
+        Whether the audio source will expire before we're done playing it, in 
+        which case it has to be looked up again. ffmpeg might have to reconnect
+        to the source in the middle of the song, so it has to last that long.
+        """
+
+        expires = self.expires()
+
+        if expires is None or not self.can_resolve():
+            return False
+
+        return time.time() + self.duration + config.get("source_expiry_margin") > expires
+
+    def can_resolve(self) -> bool:
+        """
+        Whether resolve can look up a new audio source for the song. Songs
+        saved before we kept the page they came from only have a YouTube
+        stream url, but they can still be searched for by title.
+        """
+
+        return bool(self.url) or self.expires() is not None
+
+    def resolve(self) -> bool:
+        """
+        Look up the audio source of a song that was added without one, like
+        the songs from lazily expanded playlists, or whose source has expired.
+        This blocks, so it should be run by the resolver. Returns whether it 
+        succeeded.
+        """
+
+        if not self.url:
+            if not self.can_resolve():
+                return self.is_resolved()
+
+            return self._research()
+
+        logger.debug("Resolving audio source for '%s'", self.title)
+
+        try:
+            with youtube_dl.YoutubeDL(Song._COMMON_YDL_OPTIONS) as ydl:
+                with youtube_dl_seconds.time(kind="refresh"):
+                    info = ydl.extract_info(self.url, download=False)
+        except (youtube_dl.utils.DownloadError, subprocess.SubprocessError) as e:
+            logger.warning(f"Couldn't resolve audio source for '{self.title}' from '{self.url}'", exc_info=e)
+            return False
+
+        if not info:
+            logger.warning(f"Couldn't resolve audio source for '{self.title}' from '{self.url}'")
+            return False
+
+        song = Song.from_info(info)
+
+        self.source = song.source
+        self.duration = song.duration
+        self.sample_rate = song.sample_rate
+        self.codec = song.codec
+
+        return True
+
+    def _research(self) -> bool:
+        """
+        Find a song without a url again by searching for its title, and take
+        over its page so that it can be resolved like any other song from now
+        on.
+        """
+
+        logger.debug("Searching for '%s' again, since we don't know where it came from", self.title)
+
+        try:
+            song = Song.from_query(self.title)
+        except (youtube_dl.utils.DownloadError, subprocess.SubprocessError) as e:
+            logger.warning(f"Couldn't find '{self.title}' again", exc_info=e)
+            return False
+
+        if not song:
+            return False
+
+        self.url = song.url
+        self.video_id = song.video_id
+
+        if self.loudness is None:
+            self.loudness = song.loudness
+
+        # Lazy search results don't have a source yet
+        if not song.is_resolved():
+            return self.resolve()
+
+        self.source = song.source
+        self.duration = song.duration
+        self.sample_rate = song.sample_rate
+        self.codec = song.codec
+
+        return True
 
     @staticmethod
-    def from_query(query: str) -> Song:
+    def from_query(query: str, cache_key: Optional[str] = None) -> Song:
+        """
+        Create a song from the first YouTube search result for query. Which 
+        video the query resolved to is remembered in the resolve cache under
+        cache_key (or the normalized query), so that we can skip the search 
+        the next time.
+        """
+
+        cache_key = cache_key if cache_key else ResolveCache.query_key(query)
+
+        if (cached := resolve_cache.get(cache_key)):
+            url = Song._video_url(cached['video_id'])
+
+            # We already know everything we need to show the song in the queue,
+            # so when we're lazy the audio source can be looked up later
+            if config.get("lazy_playlists") and cached['duration'] is not None:
+                return Song(Song._sanitize_title(cached['title']), None, cached['duration'], None, url, cached['video_id'],
+                            loudness=Song._cached_loudness(cached['video_id']))
+
+            songs = Song.from_youtube_url(url)
+
+            if songs:
+                return songs[0]
+
+            # The video has probably been removed since, so search again
+            logger.debug("Cached video for '%s' is not available anymore", cache_key)
     
         ydl_options = {
             **Song._COMMON_YDL_OPTIONS,
@@ -63,7 +238,8 @@ class Song:
         }
 
         with youtube_dl.YoutubeDL(ydl_options) as ydl:
-            info = ydl.extract_info(query, download=False)
+            with youtube_dl_seconds.time(kind="search"):
+                info = ydl.extract_info(query, download=False)
             
             # We don't get any info when we (probably among other things) don't
             # get any search result for the query. Just ignore it then.
@@ -72,66 +248,83 @@ class Song:
                 return None
             
             # Take the first search result from YouTube and create a song from it
-            if 'entries' in info:
+            if info.get('entries'):
                 entry_info = info['entries'][0]
-                return Song.from_source_url(entry_info['url'], title=entry_info['title'])
+                resolve_cache.put(cache_key, entry_info['id'], entry_info['title'], entry_info.get('duration'))
+                return Song.from_info(entry_info)
 
     @staticmethod
-    def from_url(url: str) -> List[Song]:
+    def from_url(url: str) -> Iterator[Song]:
         if Song._is_spotify_url(url):
             return Song.from_spotify_url(url)
         else:
             return Song.from_youtube_url(url)
 
     @staticmethod
-    def from_spotify_url(url: str) -> List[Song]:
-        
-        spotify_id = config.get("spotify_id", allow_default=False)
-        spotify_secret = config.get("spotify_secret", allow_default=False)
-
-        if not spotify_id or not spotify_secret:
-            logger.warning("Can't add song from Spotify, spotify_id or spotify_secret not set")
-            return []
+    def url_source(url: str) -> str:
+        """
+        Where the songs from_url gives for url come from.
+        """
 
-        spotify = spotipy.Spotify(
-                    auth_manager=SpotifyClientCredentials(
-                        client_id=spotify_id, 
-                        client_secret=spotify_secret))
-        
-        parsed_url = url.replace("https://open.spotify.com/", "")
-        item_type, item_id = parsed_url.split("/")
-        
-        songs = []
+        return "spotify" if Song._is_spotify_url(url) else "youtube"
 
-        try:
+    @staticmethod
+    def from_spotify_url(url: str) -> Iterator[Song]:
+        """
+        Yield a song for every track in the Spotify track, playlist or album.
+        The YouTube searches for the tracks are done concurrently, but the 
+        songs are still yielded in the same order as the tracks.
+        """
 
-            if item_type == "track":
-                songs.append(Song.from_query(Song._spotify_query_string(spotify.track(item_id))))
+        if not spotify_client.is_configured():
+            logger.warning("Can't add song from Spotify, spotify_id or spotify_secret not set")
+            return
 
-            elif item_type == "playlist":
-                for track in spotify.playlist(item_id)['tracks']['items']:
-                    songs.append(Song.from_query(Song._spotify_query_string(track['track'])))
+        # Start searching for the tracks of the first page while the rest of
+        # the pages are still being fetched
+        tracks = (track for page in spotify_client.track_pages(url) for track in page)
 
-            elif item_type == "album":
-                for track in spotify.album_tracks(item_id)['tracks']['items']:
-                    songs.append(Song.from_query(Song._spotify_query_string(track)))
+        try:
+            yield from ordered_map(Song._from_spotify_track, tracks, config.get("spotify_concurrency"))
 
         except spotipy.oauth2.SpotifyOauthError as e:
             logger.warning("Something went wrong when using Spotify credentials", exc_info=e)
-            return []
 
-        return songs
+        except spotipy.SpotifyException as e:
+            logger.warning(f"Something went wrong when getting tracks for '{url}' from Spotify", exc_info=e)
+
+    @staticmethod
+    def _from_spotify_track(track) -> Optional[Song]:
+        try:
+            cache_key = ResolveCache.spotify_key(track['id']) if track.get('id') else None
+            return Song.from_query(Song._spotify_query_string(track), cache_key)
+        except (youtube_dl.utils.DownloadError, subprocess.SubprocessError) as e:
+            # One missing track shouldn't stop the rest of the playlist
+            logger.warning(f"Couldn't find song for Spotify track '{track['name']}'", exc_info=e)
+            return None
 
     @staticmethod
     def from_youtube_url(url: str) -> List[Song]:
+        """
+        Create songs for the video or every video in the playlist at url. If
+        lazy_playlists is set, the playlist entries are only added as 
+        placeholders and their audio sources are looked up right before they
+        are played, which is a lot faster for large playlists.
+        """
+
         YDL_OPTIONS = {
             **Song._COMMON_YDL_OPTIONS,
         }
 
+        if config.get("lazy_playlists"):
+            # Only get the id, title and duration of playlist entries
+            YDL_OPTIONS['extract_flat'] = 'in_playlist'
+
         songs = []
 
         with youtube_dl.YoutubeDL(YDL_OPTIONS) as ydl:
-            info = ydl.extract_info(url, download=False)
+            with youtube_dl_seconds.time(kind="url"):
+                info = ydl.extract_info(url, download=False)
 
             # We don't get any info when we (probably among other things) don't
             # have access to the specified playlist. Just ignore it then.
@@ -141,20 +334,60 @@ class Song:
 
             if 'entries' in info:
                 for entry_info in info['entries']:
-                    songs.append(Song.from_source_url(entry_info['url'], title=entry_info['title']))
+                    # Unavailable videos in playlists show up as None
+                    if not entry_info:
+                        continue
+
+                    if entry_info.get('_type') == 'url':
+                        songs.append(Song.from_flat_info(entry_info))
+                    else:
+                        songs.append(Song.from_info(entry_info))
             else:
-                songs.append(Song.from_source_url(info['url']))
+                songs.append(Song.from_info(info))
         
         return songs
 
+    @staticmethod
+    def from_info(info: Dict) -> Song:
+        """
+        Create a song from the info youtube-dl extracted for a video. It 
+        already contains everything we need, so we only have to probe the 
+        audio source ourselves if something is missing.
+        """
+
+        duration = info.get('duration')
+        sample_rate = info.get('asr')
+
+        if duration is None or sample_rate is None:
+            logger.debug("Missing duration or sample rate for '%s', probing source instead", info.get('title'))
+            return Song.from_source_url(info['url'], title=info.get('title'))
+
+        return Song(Song._sanitize_title(info['title']), info['url'], float(duration), sample_rate,
+                    info.get('webpage_url'), info.get('id'), info.get('acodec'), Song._cached_loudness(info.get('id')))
+
+    @staticmethod
+    def from_flat_info(info: Dict) -> Song:
+        """
+        Create a song without an audio source from a flat playlist entry, which
+        only contains the id, title and (sometimes) duration of the video.
+        """
+
+        if info.get('ie_key') == 'Youtube':
+            url = Song._video_url(info['id'])
+        else:
+            url = info['url']
+
+        return Song(Song._sanitize_title(info.get('title') or info['id']), None, float(info.get('duration') or 0), None,
+                    url, info.get('id'), loudness=Song._cached_loudness(info.get('id')))
+
     @staticmethod
     def from_source_url(url: str, title: Optional[str] = None) -> Song:
         """
-        When we finally have the url to the audio source, we can use 
-        ffmpeg.probe to get all the needed information from it.
+        When we only have the url to the audio source (like for attachments),
+        we can use ffprobe to get all the needed information from it.
         """
 
-        info = ffmpeg.probe(url)
+        info = Song._probe(url)
 
         format = info['format']
         stream = info['streams'][0]
@@ -163,8 +396,27 @@ class Song:
         source = format['filename']
         duration = float(format["duration"])
         sample_rate = stream['sample_rate']
+        codec = stream.get('codec_name')
+
+        return Song(title, source, duration, sample_rate, codec=codec)
+
+    @staticmethod
+    def _probe(url: str) -> Dict:
+        """
+        Get format and stream info for url from ffprobe. Gives up after 
+        probe_timeout seconds so that a slow source can't hold up a resolver
+        worker forever.
+        """
+
+        args = ['ffprobe', '-v', 'error', '-show_format', '-show_streams', '-of', 'json', url]
+        with ffprobe_seconds.time():
+            result = subprocess.run(args, capture_output=True, check=True, timeout=config.get("probe_timeout"))
+
+        return json.loads(result.stdout)
 
-        return Song(title, source, duration, sample_rate)
+    @staticmethod
+    def _cached_loudness(video_id: Optional[str]) -> Optional[float]:
+        return resolve_cache.get_loudness(video_id) if video_id else None
 
     @staticmethod
     def _sanitize_title(title: str) -> str:
@@ -183,6 +435,10 @@ class Song:
     def _spotify_query_string(track) -> str:
         return track['name'] + ' - ' + track['artists'][0]['name']
 
+    @staticmethod
+    def _video_url(video_id: str) -> str:
+        return f"https://www.youtube.com/watch?v={video_id}"
+
     @staticmethod
     def _is_spotify_url(url: str):
         return url.startswith("https://open.spotify.com/")
\ No newline at end of file
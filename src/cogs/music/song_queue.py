@@ -1,12 +1,11 @@
-import datetime as dt
-import json
-from pathlib import Path
 import random
-from typing import Iterable, List, Callable, Any, Union, Dict
+from typing import Iterable, List, Callable, Any, Tuple, Union
 
-from utils import format_time
+from utils import format_time, MaxTree
 
 from .song import Song
+from .playlist_store import playlist_store
+from .resolver import ResolveJob
 from log import get_logger
 
 
@@ -15,9 +14,7 @@ logger = get_logger(__name__)
 
 class SongQueue:
 
-    PLAYLISTS_PATH = "playlists.json"
-
-    queue: List[Song]
+    queue: List[Union[Song, ResolveJob]]
     current: int
 
     def __init__(self, config) -> None:
@@ -26,6 +23,12 @@ class SongQueue:
         self.queue = []
         self._current = 0
 
+        # Kept up to date on every change, so that rendering the queue doesn't
+        # have to look at every song in it
+        self._total_duration = 0
+        self._durations = MaxTree()
+        self._title_lengths = MaxTree()
+
         self.subscribers = []
 
     def subscribe(self, callback: Callable[[], Any]):
@@ -50,14 +53,105 @@ class SongQueue:
     def _unprepare_index_(self, index: int):
         return index-1
 
-    def add_songs(self, songs: List[Song]):
-        self.queue.extend(songs)
+    def _splice(self, start: int, end: int, entries: List[Union[Song, ResolveJob]]):
+        """
+        Replace the entries in [start, end) with entries and update the
+        aggregates. Doesn't touch current or publish, that is up to the caller.
+        """
+
+        removed = self.queue[start:end]
+        self.queue[start:end] = entries
+
+        if start == end == len(self.queue) - len(entries):
+            # Appending is cheap for the trees, so no need to rebuild them
+            for entry in entries:
+                self._total_duration += entry.duration
+                self._durations.append(entry.duration)
+                self._title_lengths.append(len(entry.title))
+
+        elif len(removed) + len(entries) == 1:
+            # So is inserting or removing a single entry
+            for entry in removed:
+                self._total_duration -= entry.duration
+                self._durations.pop(start)
+                self._title_lengths.pop(start)
+
+            for entry in entries:
+                self._total_duration += entry.duration
+                self._durations.insert(start, entry.duration)
+                self._title_lengths.insert(start, len(entry.title))
+
+        else:
+            self._rebuild()
+
+    def _rebuild(self):
+        self._total_duration = sum(entry.duration for entry in self.queue)
+        self._durations.reset(entry.duration for entry in self.queue)
+        self._title_lengths.reset(len(entry.title) for entry in self.queue)
+
+    def _clamp_current(self):
+        if self._current >= len(self.queue):
+            self._current = max(0, len(self.queue) - 1)
+
+    def update(self, entry: Song):
+        """
+        Let the queue know that the duration or title of entry has changed,
+        like when a lazily added song has been resolved.
+        """
+
+        # Compare by identity, songs with the same contents are still
+        # different entries
+        for index, other in enumerate(self.queue):
+            if other is entry:
+                self._total_duration += entry.duration - self._durations.max(index, index + 1)
+                self._durations[index] = entry.duration
+                self._title_lengths[index] = len(entry.title)
+
         self.publish()
 
-    def add_song(self, song: Song):
-        self.queue.append(song)
+    def insert_at(self, index: int, songs: List[Union[Song, ResolveJob]]):
+        """
+        Insert songs so that the first of them gets the given index, and keep
+        pointing at the same current song.
+        """
+
+        index = min(max(0, self._unprepare_index_(index)), len(self.queue))
+        self._splice(index, index, songs)
+
+        if self.queue and index <= self._current and len(self.queue) > len(songs):
+            self._current += len(songs)
+
+        self.publish()
+
+    def add_songs(self, songs: List[Union[Song, ResolveJob]]):
+        self.insert_at(self._prepare_index_(len(self.queue)), songs)
+
+    def add_song(self, song: Union[Song, ResolveJob]):
+        self.add_songs([song])
+
+    def insert_before(self, entry: ResolveJob, song: Song):
+        """
+        Insert song right before entry, which is usually the placeholder of
+        the resolve job that produced it.
+        """
+
+        index = self.queue.index(entry)
+        self._splice(index, index, [song])
+
+        # Keep pointing at the same song, unless it was the placeholder itself
+        # in which case we now point at the newly resolved song instead
+        if index < self._current:
+            self._current += 1
+
         self.publish()
 
+    def remove_entry(self, entry: ResolveJob):
+        if entry in self.queue:
+            self.remove(self._prepare_index_(self.queue.index(entry)))
+
+    def is_pending(self, entry) -> bool:
+        return isinstance(entry, ResolveJob)
+
     def next(self):
         if self.queue:
             self.current = (self.current + 1) % len(self.queue)
@@ -71,32 +165,105 @@ class SongQueue:
         if 0 <= index < len(self.queue):
             self.current = index
 
+    def move_range(self, start: int, end: int, to: int):
+        """
+        Move the songs from start to end (inclusive) so that they come right
+        before the song currently at index to, or last if to is past the end.
+        Keeps pointing at the same current song.
+        """
+
+        start = max(0, self._unprepare_index_(start))
+        end = min(len(self.queue), end)
+        to = min(max(0, self._unprepare_index_(to)), len(self.queue))
+
+        if start >= end or start <= to <= end:
+            return
+
+        current_entry = self.queue[self._current] if self.queue else None
+
+        moved = self.queue[start:end]
+        rest = self.queue[:start] + self.queue[end:]
+
+        if to > end:
+            to -= len(moved)
+
+        self.queue = rest[:to] + moved + rest[to:]
+        self._rebuild()
+
+        self._current = next(i for i, entry in enumerate(self.queue) if entry is current_entry)
+
+        self.publish()
+
+    def replace(self, songs: List[Union[Song, ResolveJob]], current: int = 0):
+        """
+        Replace the whole queue with songs, pointing at the given index.
+        """
+
+        self._splice(0, len(self.queue), songs)
+        self._current = current
+        self._clamp_current()
+
+        self.publish()
+
     def shuffle(self):
         random.shuffle(self.queue)
+        self._rebuild()
 
     def clear(self):
-        self.queue = []
-        self.current = 0
+        self.replace([])
+
+    def remove_range(self, start: int, end: int):
+        """
+        Remove the songs from start to end (inclusive).
+        """
+
+        self.remove_ranges([(start, end)])
+
+    def remove_ranges(self, ranges: Iterable[Tuple[int, int]]):
+        """
+        Remove the songs in every (start, end) range (inclusive). Ranges may
+        overlap and parts of them outside the queue are ignored.
+        """
+
+        # Clip them to the queue and merge the ones that overlap or touch
+        merged = []
+        for start, end in sorted((max(0, self._unprepare_index_(start)), min(len(self.queue), end))
+                                 for start, end in ranges):
+            if start >= end:
+                continue
+
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
 
-    def remove(self, arg: Union[Iterable[int], int]):
+        if not merged:
+            return
 
-        if isinstance(arg, int):
-            index = self._unprepare_index_(arg)
+        # Keep pointing at the same song if it is still there, otherwise at
+        # the first one after it that is left
+        removed_before = sum(min(end, self._current) - start for start, end in merged if start < self._current)
 
-            if 0 <= index < len(self.queue):
-                del self.queue[index]
-            
-            # Decrease index if we removed song before current one in queue or
-            # we remove the song at the end of the queue that was not the last song
-            if index < self.current or (index != 0 and self.current == len(self.queue)):
-                self.current -= 1
+        if len(merged) == 1:
+            self._splice(merged[0][0], merged[0][1], [])
+        else:
+            queue = []
+            kept_from = 0
+
+            for start, end in merged:
+                queue.extend(self.queue[kept_from:start])
+                kept_from = end
+
+            queue.extend(self.queue[kept_from:])
+            self._splice(0, len(self.queue), queue)
+
+        self._current -= removed_before
+        self._clamp_current()
+
+        self.publish()
 
-        elif isinstance(arg, Iterable):
-            # Remove the songs back to front so that we remove the correct song, 
-            # otherwise we would remove a song before another one and its index 
-            # would change causing us to remove the wrong one.
-            for index in sorted(arg, reverse=True):
-                self.remove(index)
+    def remove(self, index: int):
+        self.remove_range(index, index)
 
     def num_songs(self) -> int:
         return len(self.queue)
@@ -114,90 +281,39 @@ class SongQueue:
 
         return self.queue[self.current]
 
-    def get_playlists(self) -> Dict:
-        if not Path(SongQueue.PLAYLISTS_PATH).exists():
-            logger.warning(f"Can't load playlists, file '{SongQueue.PLAYLISTS_PATH}' not found")
-            return {}
-
-        with open(SongQueue.PLAYLISTS_PATH, encoding="utf8") as f:
-            return [(key, value["description"], value["songs"]) for key, value in json.loads(f.read()).items()]
+    def get_playlists(self) -> List[Tuple[str, str, int]]:
+        return playlist_store.playlists()
 
     def get_queue(self) -> List[Song]:
         return self.queue
 
     def duration(self, time_scaling: int = 1) -> str:
-        total_seconds = int(sum(song.duration/time_scaling for song in self.queue))
+        total_seconds = int(self._total_duration/time_scaling)
         return format_time(total_seconds, show_hours=(total_seconds > 3600))
 
     def _longest_song_between(self, start: int, end: int) -> int:
-        return max(song.duration for song in self.queue[start:end])
+        return self._durations.max(start, end)
 
     def save(self, name: str, desc: str = None) -> bool:
         if len(self.queue) == 0:
             return False
-        
-        playlists = {}
-        if Path(SongQueue.PLAYLISTS_PATH).exists():
-            with open(SongQueue.PLAYLISTS_PATH, encoding="utf8") as f:
-                playlists = json.loads(f.read())
-        
-        if name not in playlists:
-            playlists[name] = {
-                                "created": dt.datetime.now().strftime("%Y-%m-%d %H:%M"), 
-                                "updated": dt.datetime.now().strftime("%Y-%m-%d %H:%M"),
-                                "description": desc if desc else "Ingen beskrivning",
-                                "songs": [], 
-                            }
-
-        playlists[name]["updated"] = dt.datetime.now().strftime("%Y-%m-%d %H:%M")
-        playlists[name]["songs"] = [song.to_json() for song in self.queue]
-
-        if desc:
-            playlists[name]["description"] = desc
-        
-        with open(SongQueue.PLAYLISTS_PATH, "w", encoding="utf8") as f:
-            f.write(json.dumps(playlists, indent=4))
-        
+
+        playlist_store.save(name, desc, [song.to_json() for song in self.queue if not self.is_pending(song)])
+
         return True
 
     def load(self, name: str) -> bool:
-        if not Path(SongQueue.PLAYLISTS_PATH).exists():
-            logger.warning(f"Can't load playlists, file '{SongQueue.PLAYLISTS_PATH}' not found")
-            return False
-        
-        with open(SongQueue.PLAYLISTS_PATH, encoding="utf8") as f:
-            playlists = json.loads(f.read())
+        songs = playlist_store.load(name)
 
-        if name not in playlists:
+        if songs is None:
             logger.warning(f"Can't load playlist '{name}', playlist not found")
             return False
-        
-        # The source link gotten from youtube-dl apparently expire after some
-        # (unknown to us) time. So if we load a playlist that hasn't been
-        # updated for some time need to gather info for the songs again. We
-        # probably need to save updated time for each entry instead to make
-        # this always work. TODO: Look into to this to see if there is a
-        # better solution, like saving another link or simply keep track 
-        # of when each song was updated. Maybe add command to update playlist
-        # like this in worst case.
-
-        updated_time = dt.datetime.strptime(playlists[name]['updated'], "%Y-%m-%d %H:%M")
-        time_since_updated = dt.datetime.now() - updated_time
-
-        if time_since_updated > dt.timedelta(hours=4):
-            for song in playlists[name]['songs']:
-                if (url := song.get('url')):
-                    # If it has a url, the source was from Youtube, in which
-                    # case we need to update it.
-                    self.queue.extend(Song.from_youtube_url(url))
-                else:
-                    # Otherwise we can just add it normally
-                    self.queue.append(song)
-            self.save(name)
-        else:
-            self.queue.extend([Song.from_json(song) for song in playlists[name]['songs']])
 
-        self.publish()
+        # The source links gotten from youtube-dl expire after a while, but
+        # every song knows when its source expires and where to get a new one,
+        # so they are refreshed in the background a few songs before they are
+        # played instead.
+        self.add_songs([Song.from_json(song) for song in songs])
 
         return True
 
@@ -226,7 +342,7 @@ class SongQueue:
         end = min(len(self.queue), (self.current+after_current)+extra_end)
 
         index_len = len(str(end)) + 1
-        title_len = min(title_max_len, max(len(song.title) for song in self.queue))
+        title_len = min(title_max_len, self._title_lengths.max())
 
         entries = []
 
@@ -246,7 +362,9 @@ class SongQueue:
 
             entry = f"{index:<{index_len}} {title:<{title_len}}"
 
-            if i == self._prepare_index_(self.current):
+            if self.is_pending(song):
+                entry = f"{entry} [{song.progress_string()}]"
+            elif i == self._prepare_index_(self.current):
                 # Format current song time
                 current_time = format_time(int(current_music_time), show_hours=show_hours)
 
@@ -0,0 +1,120 @@
+from __future__ import annotations
+import threading
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from urllib.parse import urlparse
+
+from log import get_logger
+from config import config
+from utils import LazyModule
+
+logger = get_logger(__name__)
+
+# Only imported once we actually talk to Spotify
+requests = LazyModule("requests")
+spotipy = LazyModule("spotipy")
+
+
+class SpotifyClient:
+    """
+    A long lived Spotify client. The access token is cached in memory and the
+    HTTP session is reused between requests, so we only authenticate when the
+    token actually expires.
+    """
+
+    # The largest page sizes the Spotify API allows for each endpoint
+    PLAYLIST_PAGE_SIZE = 100
+    ALBUM_PAGE_SIZE = 50
+    TRACKS_BATCH_SIZE = 50
+
+    # Only ask for the fields we actually use from playlists
+    PLAYLIST_FIELDS = "items(track(id,name,artists(name))),next"
+
+    def __init__(self, config):
+        self.config = config
+
+        self._spotify: Optional[spotipy.Spotify] = None
+        self._credentials: Optional[Tuple[str, str]] = None
+        self._lock = threading.Lock()
+
+    def is_configured(self) -> bool:
+        return bool(self.config.get("spotify_id", allow_default=False)
+                and self.config.get("spotify_secret", allow_default=False))
+
+    def _client(self) -> spotipy.Spotify:
+        credentials = (self.config.get("spotify_id"), self.config.get("spotify_secret"))
+
+        with self._lock:
+            # Only create a new client the first time or if the credentials
+            # have changed since then
+            if self._spotify is None or self._credentials != credentials:
+                logger.debug("Creating new Spotify client")
+
+                session = requests.Session()
+                auth_manager = spotipy.SpotifyClientCredentials(
+                                client_id=credentials[0],
+                                client_secret=credentials[1],
+                                requests_session=session,
+                                cache_handler=spotipy.MemoryCacheHandler())
+
+                self._spotify = spotipy.Spotify(auth_manager=auth_manager, requests_session=session)
+                self._credentials = credentials
+
+            return self._spotify
+
+    def track_pages(self, url: str) -> Iterator[List[Dict]]:
+        """
+        Yield the tracks of a Spotify track, playlist or album url one page at
+        a time, following the pagination until every track has been fetched.
+        """
+
+        item_type, item_id = SpotifyClient.parse_url(url)
+
+        spotify = self._client()
+
+        if item_type == "track":
+            yield from self.tracks([item_id])
+
+        elif item_type == "playlist":
+            page = spotify.playlist_items(item_id, fields=SpotifyClient.PLAYLIST_FIELDS,
+                                          limit=SpotifyClient.PLAYLIST_PAGE_SIZE, additional_types=("track",))
+            while page:
+                # Tracks that have been removed from Spotify show up as None
+                yield [item['track'] for item in page['items'] if item['track']]
+                page = spotify.next(page) if page['next'] else None
+
+        elif item_type == "album":
+            page = spotify.album_tracks(item_id, limit=SpotifyClient.ALBUM_PAGE_SIZE)
+            while page:
+                yield page['items']
+                page = spotify.next(page) if page['next'] else None
+
+        else:
+            logger.warning(f"Can't get tracks from Spotify, unknown item type '{item_type}'")
+
+    def tracks(self, track_ids: Iterable[str]) -> Iterator[List[Dict]]:
+        """
+        Fetch full track objects using the multiple tracks endpoint, in
+        batches as large as the API allows.
+        """
+
+        spotify = self._client()
+        track_ids = list(track_ids)
+
+        for i in range(0, len(track_ids), SpotifyClient.TRACKS_BATCH_SIZE):
+            batch = track_ids[i:i+SpotifyClient.TRACKS_BATCH_SIZE]
+            yield [track for track in spotify.tracks(batch)['tracks'] if track]
+
+    @staticmethod
+    def parse_url(url: str) -> Tuple[str, str]:
+        """
+        Get the item type and id from a Spotify url.
+
+        >>> SpotifyClient.parse_url("https://open.spotify.com/intl-sv/album/1A2B3C?si=xyz")
+        ("album", "1A2B3C")
+        """
+
+        item_type, item_id = urlparse(url).path.strip('/').split('/')[-2:]
+        return item_type, item_id
+
+
+spotify_client = SpotifyClient(config)
@@ -0,0 +1,89 @@
+from collections import defaultdict
+from difflib import SequenceMatcher
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from discord.ext import commands
+
+from log import get_logger
+
+logger = get_logger(__name__)
+
+
+class CommandIndex:
+    """
+    Finds the command that someone most likely meant when they misspelled
+    it. Every command name and alias is split into trigrams once, so a lookup
+    only has to compare the misspelling against the few names that share the
+    most trigrams with it, instead of against every one of them.
+    """
+
+    # How many of the names that share the most trigrams to compare
+    CANDIDATES = 8
+
+    def __init__(self, threshold: float):
+        self.threshold = threshold
+
+        # Every name and alias, in the order the commands were added, along
+        # with the command it invokes
+        self._names: List[Tuple[str, commands.Command]] = []
+        self._trigrams: Dict[str, Set[int]] = defaultdict(set)
+
+    def build(self, all_commands: Iterable[commands.Command]):
+        self._names = []
+        self._trigrams = defaultdict(set)
+
+        for command in all_commands:
+            for name in [command.name, *command.aliases]:
+                index = len(self._names)
+                self._names.append((name, command))
+
+                for trigram in CommandIndex._split(name):
+                    self._trigrams[trigram].add(index)
+
+        logger.debug(f"Indexed {len(self._names)} command names")
+
+    def lookup(self, word: str) -> Optional[Tuple[commands.Command, str]]:
+        """
+        Get the command that word most likely was meant to be and the name
+        or alias of it that is closest, or None if nothing is close enough.
+        """
+
+        counts = defaultdict(int)
+        for trigram in CommandIndex._split(word):
+            for index in self._trigrams.get(trigram, ()):
+                counts[index] += 1
+
+        if counts:
+            candidates = sorted(sorted(counts), key=counts.get, reverse=True)[:CommandIndex.CANDIDATES]
+        else:
+            # Nothing in common at all, which is rare enough that we can
+            # afford to compare against everything
+            candidates = range(len(self._names))
+
+        best_index, best_ratio = None, 0
+
+        # Compare in the order the names were added, so that ties go to the
+        # same command every time
+        for index in sorted(candidates):
+            ratio = SequenceMatcher(None, word, self._names[index][0]).ratio()
+            if ratio > best_ratio:
+                best_index, best_ratio = index, ratio
+
+        if best_index is None or best_ratio <= self.threshold:
+            return None
+
+        name, command = self._names[best_index]
+        return command, name
+
+    @staticmethod
+    def _split(word: str) -> Set[str]:
+        """
+        The trigrams of word, padded so that even one letter words have some
+        and the start and end of the word count for more.
+
+        >>> CommandIndex._split("kö")
+        {"  k", " kö", "kö ", "ö  "}
+        """
+
+        padded = f"  {word.lower()}  "
+        return {padded[i:i+3] for i in range(len(padded) - 2)}
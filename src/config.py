@@ -1,6 +1,10 @@
+import copy
 import json
 import os
 from pathlib import Path
+import tempfile
+import threading
+from typing import Any, Callable, Dict, Iterable, Optional
 
 from log import get_logger
 
@@ -23,22 +27,75 @@ class Config:
         "nightcore_tempo": 1.2,
         "nightcore_pitch": 1.15,
         "queue_message_threshold": 5,
-        "update_interval": 5,
+        "update_interval": 5, # How often the elapsed time in the queue message is updated while playing
+        "render_delay": 0.5, # Changes within this many seconds are shown with a single edit
+        "resolve_workers": 4,
+        "spotify_concurrency": 8,
+        "resolve_cache_path": "resolve_cache.db",
+        "resolve_cache_ttl": 604800, # One week
+        "resolve_cache_max_entries": 10000,
+        "probe_timeout": 10,
+        "lazy_playlists": True,
+        "source_expiry_margin": 60,
+        "prefetch_time": 10,
+        "prefetch_frames": 50, # Each frame is 20 ms of audio
+        "refresh_ahead": 3, # How many of the upcoming songs to keep fresh sources for
+        "audio_cache_path": "audio_cache",
+        "audio_cache_max_bytes": 2147483648, # Can be set to 0 to disable the audio cache
+        "opus_playback": True,
+        "opus_bitrate": 128,
+        "loudness_target": -24, # In LUFS, the same as the default of loudnorm
+        "loudness_analysis_timeout": 120,
+        "playlists_path": "playlists.db",
+        "guilds": {}, # The values each guild has changed for just itself
+        "log_level": "DEBUG",
+        "log_levels": {}, # Levels for single modules or packages, like {"cogs.music": "INFO"}
+        "log_max_bytes": 5242880, # The log file is rotated when it grows larger than this
+        "log_backups": 3,
+        "metrics_host": "127.0.0.1",
+        "metrics_port": 9464, # Where Prometheus can get the metrics, can be set to 0 to disable it
+        "loop_lag_interval": 0.1, # How often to check how late the event loop is
+        "loop_lag_threshold": 0.2, # Log what blocked the event loop when it is this late, can be set to 0 to disable it
     }
 
+    # How long to wait for more changes before writing them to disk
+    SAVE_DELAY = 1
+
     def __init__(self, path: str):
         self.path = Path(path)
         self.config = {}
         self.subscribers = []
 
+        # Changes are written to disk in the background, a while after they
+        # are made, so the timer and the config have to be protected
+        self._save_timer: Optional[threading.Timer] = None
+        self._lock = threading.RLock()
+
+        # Only one write at a time, so that an older version can't end up
+        # replacing a newer one. Kept apart from _lock so that changing the
+        # config never has to wait for the disk.
+        self._write_lock = threading.Lock()
+
         self.load(self.path)
 
-    def subscribe(self, callback):
-        self.subscribers.append(callback)
+    def subscribe(self, callback: Callable[[], Any], keys: Optional[Iterable[str]] = None):
+        """
+        Call callback whenever one of keys changes, or any key if not given.
+        """
+
+        self.subscribers.append((callback, set(keys) if keys is not None else None))
 
-    def publish(self):
-        for callback in self.subscribers:
-            callback()
+    def unsubscribe(self, callback: Callable[[], Any]):
+        self.subscribers = [(other, keys) for other, keys in self.subscribers if other != callback]
+
+    def publish(self, key: Optional[str] = None):
+        """
+        Notify the subscribers of key, or every subscriber if not given.
+        """
+
+        for callback, keys in list(self.subscribers):
+            if key is None or keys is None or key in keys:
+                callback()
 
     def get(self, key: str, allow_default=True):
         if key in self.config:
@@ -54,9 +111,10 @@ class Config:
     def set(self, key: str, value):
         if key in self.config:
             logger.debug(f"Setting config variable '{key}' to '{value}'.")
-            self.config[key] = value
+            with self._lock:
+                self.config[key] = value
             self.save()
-            self.publish()
+            self.publish(key)
         else:
             logger.warning(f"Can't set config varible '{key}', it doesn't exist.")
 
@@ -73,6 +131,18 @@ class Config:
     def toggle(self, key: str):
         self.set(key, not self.get(key))
 
+    def get_guild(self, guild_id: int) -> Dict:
+        """
+        The values guild_id has changed for just itself.
+        """
+
+        return dict(self.config["guilds"].get(str(guild_id), {}))
+
+    def set_guild(self, guild_id: int, key: str, value):
+        with self._lock:
+            self.config["guilds"].setdefault(str(guild_id), {})[key] = value
+        self.save()
+
     def load(self, path: Path):
         self.path = path
 
@@ -84,8 +154,8 @@ class Config:
 
         else:
             logger.debug(f"Config file '{path}' not found, using default configuration")
-            self.config = Config.DEFAULT
-            self.save()
+            self.config = copy.deepcopy(Config.DEFAULT)
+            self.flush()
 
         self.publish()
 
@@ -97,7 +167,7 @@ class Config:
 
         for key in new_keys:
             logger.debug(f"Adding default value for new config variable '{key}'")
-            self.config[key] = Config.DEFAULT[key]
+            self.config[key] = copy.deepcopy(Config.DEFAULT[key])
         
         old_keys = my_keys.difference(default_keys)
 
@@ -106,11 +176,105 @@ class Config:
             del self.config[key]
 
         if new_keys or old_keys:
-            self.save()
+            self.flush()
 
     def save(self):
-        with open(self.path, "w", encoding="utf8") as f:
-            f.write(json.dumps(self.config, indent=4))
+        """
+        Write the config to disk in a little while, together with any other
+        changes made until then.
+        """
+
+        with self._lock:
+            if self._save_timer is None:
+                self._save_timer = threading.Timer(Config.SAVE_DELAY, self.flush)
+                self._save_timer.start()
+
+    def flush(self):
+        """
+        Write the config to disk right away. It is first written to a
+        temporary file that then replaces the config file, so that it is
+        never left half written.
+        """
+
+        with self._write_lock:
+            with self._lock:
+                if self._save_timer is not None:
+                    self._save_timer.cancel()
+                    self._save_timer = None
+
+                contents = json.dumps(self.config, indent=4)
+
+            with tempfile.NamedTemporaryFile("w", encoding="utf8", dir=self.path.parent,
+                                             prefix=self.path.name, suffix=".tmp", delete=False) as f:
+                try:
+                    f.write(contents)
+                    f.flush()
+                    os.fsync(f.fileno())
+                except OSError:
+                    os.unlink(f.name)
+                    raise
+
+            try:
+                os.replace(f.name, self.path)
+            except OSError:
+                os.unlink(f.name)
+                raise
+
+
+class GuildConfig:
+    """
+    The config as seen from a single guild. The values in GUILD_KEYS can be
+    changed for just this guild and are remembered between restarts,
+    everything else is read from and written to the global config.
+    """
+
+    GUILD_KEYS = {
+        "is_looping_queue",
+        "is_looping_song",
+        "nightcore",
+    }
+
+    def __init__(self, config: Config, guild_id: int):
+        self.global_config = config
+        self.guild_id = guild_id
+        self.overrides = config.get_guild(guild_id)
+        self.subscribers = []
+
+    def subscribe(self, callback: Callable[[], Any], keys: Optional[Iterable[str]] = None):
+        """
+        Call callback whenever one of keys changes for this guild, or any key
+        if not given.
+        """
+
+        self.subscribers.append((callback, set(keys) if keys is not None else None))
+        self.global_config.subscribe(callback, keys)
+
+    def publish(self, key: Optional[str] = None):
+        for callback, keys in list(self.subscribers):
+            if key is None or keys is None or key in keys:
+                callback()
+
+    def close(self):
+        for callback, _ in self.subscribers:
+            self.global_config.unsubscribe(callback)
+
+    def get(self, key: str, allow_default=True):
+        if key in self.overrides:
+            return self.overrides[key]
+
+        return self.global_config.get(key, allow_default)
+
+    def set(self, key: str, value):
+        if key in GuildConfig.GUILD_KEYS:
+            logger.debug(f"Setting guild config variable '{key}' to '{value}'.")
+            self.overrides[key] = value
+            self.global_config.set_guild(self.guild_id, key, value)
+            self.publish(key)
+        else:
+            self.global_config.set(key, value)
+
+    def toggle(self, key: str):
+        self.set(key, not self.get(key))
 
 
 config = Config('config.json')
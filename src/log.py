@@ -1,20 +1,141 @@
+import atexit
 import logging
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+import queue
+from typing import Dict, Optional
 
-def get_logger(name: str) -> logging.Logger:
-    logger = logging.getLogger(name)
-    logger.setLevel(logging.DEBUG)
+LOG_PATH = 'stefan.log'
 
-    formatter = logging.Formatter(u'[%(asctime)s, %(module)s:%(lineno)d] %(levelname)s: %(message)s', "%H:%M:%S")
+_FORMATTER = logging.Formatter(u'[%(asctime)s, %(module)s:%(lineno)d] %(levelname)s: %(message)s', "%H:%M:%S")
 
-    file_handler = logging.FileHandler('stefan.log', encoding='utf-8')
-    file_handler.setLevel(logging.INFO)
-    file_handler.setFormatter(formatter)
 
+class _DeferredQueueHandler(QueueHandler):
+    """
+    Puts records on the queue as they are. The queue never leaves this
+    process, so unlike the default QueueHandler we don't have to format the
+    message up front, that is left to the listener thread instead.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+# Every logger puts its records on this queue, and a single background thread
+# writes them to the console and the log file, so that logging never blocks
+# the event loop on disk. The thread is started by configure(), so records
+# logged before that (like while the config is loaded) wait on the queue.
+_queue = queue.SimpleQueue()
+_queue_handler = _DeferredQueueHandler(_queue)
+_listener: Optional[QueueListener] = None
+
+_default_level = logging.DEBUG
+_levels: Dict[str, int] = {}
+
+
+def _level(name: str) -> int:
+    """
+    The level of the most specific module in levels that name is in, like
+    'cogs.music' for 'cogs.music.song'.
+    """
+
+    while name:
+        if name in _levels:
+            return _levels[name]
+        name = name.rpartition('.')[0]
+
+    return _default_level
+
+
+def _parse_level(name: str, fallback: int) -> int:
+    """
+    The level called name, or fallback with a warning if there is no such
+    level, since getLevelName just gives back a string for those.
+    """
+
+    level = logging.getLevelName(str(name).upper())
+
+    if not isinstance(level, int):
+        get_logger(__name__).warning(f"Unknown log level '{name}', using {logging.getLevelName(fallback)} instead")
+        return fallback
+
+    return level
+
+
+def _stream_handler() -> logging.Handler:
     stream_handler = logging.StreamHandler()
     stream_handler.setLevel(logging.DEBUG)
-    stream_handler.setFormatter(formatter)
+    stream_handler.setFormatter(_FORMATTER)
+
+    return stream_handler
+
+
+def _start(max_bytes: int, backup_count: int):
+    global _listener
+
+    if _listener:
+        _listener.stop()
+
+    file_handler = RotatingFileHandler(LOG_PATH, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8')
+    file_handler.setLevel(logging.INFO)
+    file_handler.setFormatter(_FORMATTER)
+
+    _listener = QueueListener(_queue, file_handler, _stream_handler(), respect_handler_level=True)
+    _listener.start()
+
+
+def configure(level: str, levels: Dict[str, str], max_bytes: int, backup_count: int):
+    """
+    Set the level of every logger, where levels can override it for single
+    modules or packages, and how large the log file may grow before it is
+    rotated. Meant to be called once at startup, when the config is loaded.
+    """
+
+    global _default_level, _levels
+
+    _default_level = _parse_level(level, logging.INFO)
+    _levels = {name: _parse_level(module_level, _default_level) for name, module_level in levels.items()}
+
+    for name, logger in logging.root.manager.loggerDict.items():
+        if isinstance(logger, logging.Logger) and _queue_handler in logger.handlers:
+            logger.setLevel(_level(name))
+
+    _start(max_bytes, backup_count)
+
+
+def shutdown():
+    """
+    Write every record that is still queued and stop the listener thread.
+    If configure() was never called, like when loading the config failed,
+    the queued records are still written to the console.
+    """
+
+    global _listener
+
+    if _listener:
+        _listener.stop()
+        _listener = None
+        return
+
+    stream_handler = _stream_handler()
+
+    while True:
+        try:
+            record = _queue.get_nowait()
+        except queue.Empty:
+            break
+
+        stream_handler.handle(record)
+
+
+def get_logger(name: str) -> logging.Logger:
+    logger = logging.getLogger(name)
+    logger.setLevel(_level(name))
+
+    # Asking for the same logger twice shouldn't make it log everything twice
+    if _queue_handler not in logger.handlers:
+        logger.addHandler(_queue_handler)
+
+    return logger
 
-    logger.addHandler(file_handler)
-    logger.addHandler(stream_handler)
 
-    return logger
\ No newline at end of file
+atexit.register(shutdown)
@@ -1,13 +1,23 @@
+import startup
+
 import discord.errors
+startup.mark("import discord")
 
+import log
 from config import config
 from log import get_logger
+startup.mark("load config")
+
 from stefan import Stefan
+startup.mark("import bot")
 
 logger = get_logger(__name__)
 
 def main():
 
+    log.configure(config.get("log_level"), config.get("log_levels"),
+                  config.get("log_max_bytes"), config.get("log_backups"))
+
     config.set_from_env_var('token', 'DISCORD_TOKEN')
     config.set_from_env_var('spotify_id', 'SPOTIFY_ID')
     config.set_from_env_var('spotify_secret', 'SPOTIFY_SECRET')
@@ -27,10 +37,14 @@ def main():
         intents.message_content = True
 
         stefan = Stefan(command_prefix=prefix, intents=intents)
+        startup.mark("create bot")
 
         stefan.run(config.get("token"), log_handler=None)
     except discord.errors.LoginFailure as e:
         logger.error("Something went wrong when using discord credentials", exc_info=e)
+    finally:
+        # Don't lose changes that haven't been written yet
+        config.flush()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,273 @@
+"""
+Counters, gauges and latency histograms for the things that can make the bot
+slow, like commands, lookups and ffmpeg. They are shown by the stats command
+and served in the Prometheus text format on metrics_port.
+"""
+
+from __future__ import annotations
+import bisect
+from contextlib import contextmanager
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+from aiohttp import web
+
+from log import get_logger
+
+logger = get_logger(__name__)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class _Metric:
+
+    TYPE = ""
+
+    def __init__(self, name: str, help: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+
+        # Values are recorded from the resolver threads as well
+        self._lock = threading.Lock()
+
+    def _labels(self, labels: Dict[str, str]) -> Labels:
+        assert set(labels) == set(self.label_names), f"{self.name} takes the labels {self.label_names}"
+        return tuple((name, str(labels[name])) for name in self.label_names)
+
+    def remove(self, **labels):
+        """
+        Forget the value for labels, like when a guild is no longer used.
+        """
+
+        with self._lock:
+            self._values.pop(self._labels(labels), None)
+
+    def render(self) -> List[str]:
+        return []
+
+
+class Counter(_Metric):
+
+    TYPE = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._labels(labels)
+
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def values(self) -> Dict[Labels, float]:
+        with self._lock:
+            return dict(self._values)
+
+    def total(self) -> float:
+        with self._lock:
+            return sum(self._values.values())
+
+    def render(self) -> List[str]:
+        return [f"{self.name}{_format_labels(labels)} {value}" for labels, value in self.values().items()]
+
+
+class Gauge(Counter):
+
+    TYPE = "gauge"
+
+    def set(self, value: float, **labels):
+        key = self._labels(labels)
+
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    """
+    Counts how many observations fall in each bucket, which is enough to
+    estimate percentiles without keeping every observation around.
+    """
+
+    TYPE = "histogram"
+
+    # In seconds, from a few milliseconds for cached lookups to a minute for
+    # large playlists
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, *args, buckets: Sequence[float] = BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(buckets)
+
+        # The count of every bucket (the last one is everything above the
+        # largest bucket), and the sum of all observations
+        self._values: Dict[Labels, List[int]] = {}
+        self._sums: Dict[Labels, float] = {}
+
+    def remove(self, **labels):
+        super().remove(**labels)
+
+        with self._lock:
+            self._sums.pop(self._labels(labels), None)
+
+    def observe(self, value: float, **labels):
+        key = self._labels(labels)
+
+        with self._lock:
+            counts = self._values.setdefault(key, [0] * (len(self.buckets) + 1))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._sums[key] = self._sums.get(key, 0) + value
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        """
+        Observe how many seconds the block takes, even if it raises.
+        """
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def label_values(self) -> List[Labels]:
+        with self._lock:
+            return list(self._values)
+
+    def count(self, **labels) -> int:
+        with self._lock:
+            return sum(self._values.get(self._labels(labels), []))
+
+    def quantile(self, q: float, **labels) -> Optional[float]:
+        """
+        Estimate the q quantile by assuming that the observations are spread
+        evenly within their bucket, like Prometheus' histogram_quantile does.
+        None if nothing has been observed.
+        """
+
+        with self._lock:
+            counts = list(self._values.get(self._labels(labels), []))
+
+        rank = q * sum(counts)
+        seen = 0
+
+        for index, count in enumerate(counts):
+            if count and seen + count >= rank:
+                if index == len(self.buckets):
+                    # We don't know how far above the largest bucket it is
+                    return self.buckets[-1]
+
+                lower = self.buckets[index - 1] if index else 0
+                upper = self.buckets[index]
+                return lower + (upper - lower) * (rank - seen) / count
+
+            seen += count
+
+        return None
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = {labels: (list(counts), self._sums[labels]) for labels, counts in self._values.items()}
+
+        lines = []
+
+        for labels, (counts, total) in values.items():
+            cumulative = 0
+
+            for bucket, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(labels + (('le', str(bucket)),))} {cumulative}")
+
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {cumulative}")
+
+        return lines
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
+
+
+class Registry:
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def _add(self, metric: _Metric) -> _Metric:
+        # Modules may be imported more than once (like in the benchmarks), so
+        # asking for the same metric again gives back the one we have
+        return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, help: str, label_names: Sequence[str] = ()) -> Counter:
+        return self._add(Counter(name, help, label_names))
+
+    def gauge(self, name: str, help: str, label_names: Sequence[str] = ()) -> Gauge:
+        return self._add(Gauge(name, help, label_names))
+
+    def histogram(self, name: str, help: str, label_names: Sequence[str] = (), **kwargs) -> Histogram:
+        return self._add(Histogram(name, help, label_names, **kwargs))
+
+    def get(self, name: str) -> Optional[_Metric]:
+        return self._metrics.get(name)
+
+    def render(self) -> str:
+        """
+        Every metric in the Prometheus text format.
+        """
+
+        lines = []
+
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.TYPE}")
+            lines.extend(metric.render())
+
+        return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """
+    Serves the metrics of registry at /metrics, so that Prometheus can scrape
+    them. Runs on the event loop of the bot.
+    """
+
+    def __init__(self, registry: Registry, host: str, port: int):
+        self.registry = registry
+        self.host = host
+        self.port = port
+
+        self._runner: Optional[web.AppRunner] = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle)
+
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+
+        try:
+            await web.TCPSite(self._runner, self.host, self.port).start()
+        except OSError as e:
+            logger.warning(f"Can't serve metrics on {self.host}:{self.port}", exc_info=e)
+            await self.stop()
+            return
+
+        logger.info(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        return web.Response(text=self.registry.render(),
+                            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+
+metrics = Registry()
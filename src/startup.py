@@ -0,0 +1,136 @@
+"""
+Keeps track of how long starting the bot takes, so that it is easy to see
+when something makes it slower. Besides the steps marked by main, it times
+the import of every module until the report is made: each of our own modules
+separately, and everything else by its top level package (like discord or
+youtube_dl). Should be imported before anything else.
+"""
+
+from collections import defaultdict
+import os
+import sys
+import threading
+import time
+from typing import Dict, List, Set, Tuple
+
+_start = time.perf_counter()
+_marks: List[Tuple[str, float]] = []
+_reported = False
+
+_SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# How many of the slowest imports the report shows
+_MAX_IMPORTS = 10
+
+# The time spent importing each module (or package), not counting the
+# modules it imports itself, and which of them are our own
+_import_times: Dict[str, float] = defaultdict(float)
+_own_modules: Set[str] = set()
+
+
+class _TimedLoader:
+    """
+    Wraps the loader of a module to time running it. Everything else is
+    passed on to the real loader.
+    """
+
+    # The modules being imported on each thread, with how long the imports
+    # they did themselves took
+    _stack = threading.local()
+
+    def __init__(self, loader, key: str):
+        self._loader = loader
+        self._key = key
+
+    def __getattr__(self, attribute):
+        return getattr(self._loader, attribute)
+
+    def create_module(self, spec):
+        return self._loader.create_module(spec)
+
+    def exec_module(self, module):
+        stack = _TimedLoader._stack.__dict__.setdefault('entries', [])
+        stack.append([self._key, 0.0])
+        start = time.perf_counter()
+
+        try:
+            self._loader.exec_module(module)
+        finally:
+            elapsed = time.perf_counter() - start
+            key, nested = stack.pop()
+            _import_times[key] += elapsed - nested
+
+            if stack:
+                stack[-1][1] += elapsed
+
+
+class _ImportTimer:
+    """
+    Finds modules with the finders after it on sys.meta_path, and wraps their
+    loaders to time them.
+    """
+
+    def find_spec(self, name, path, target=None):
+        for finder in sys.meta_path[sys.meta_path.index(self) + 1:]:
+            if (find_spec := getattr(finder, 'find_spec', None)) and (spec := find_spec(name, path, target)):
+                break
+        else:
+            return None
+
+        if spec.loader is None or not hasattr(spec.loader, 'exec_module'):
+            return spec
+
+        if spec.origin and os.path.abspath(spec.origin).startswith(_SOURCE_DIR):
+            key = name
+            _own_modules.add(name)
+        else:
+            key = name.partition('.')[0]
+
+        spec.loader = _TimedLoader(spec.loader, key)
+        return spec
+
+
+_import_timer = _ImportTimer()
+sys.meta_path.insert(0, _import_timer)
+
+
+def mark(name: str):
+    """
+    Remember that the step called name is done now.
+    """
+
+    _marks.append((name, time.perf_counter()))
+
+
+def report() -> str:
+    """
+    How long every step took and how long it has been since we started.
+    Only returns the report the first time it is called, since reconnecting
+    calls on_ready again.
+    """
+
+    global _reported
+
+    if _reported:
+        return ""
+
+    _reported = True
+
+    lines = []
+    previous = _start
+
+    for name, timestamp in _marks:
+        lines.append(f"{name}: {(timestamp - previous) * 1000:.0f} ms")
+        previous = timestamp
+
+    lines.append(f"total: {(previous - _start) * 1000:.0f} ms")
+
+    # Imports after startup are logged by LazyModule instead
+    sys.meta_path.remove(_import_timer)
+
+    def slowest(names) -> str:
+        names = sorted(names, key=lambda name: -_import_times[name])[:_MAX_IMPORTS]
+        return ", ".join(f"{name}: {_import_times[name] * 1000:.0f} ms" for name in names)
+
+    return (f"Startup times: {', '.join(lines)}. Slowest imports: {slowest(_import_times)}. "
+            f"Slowest of our modules: {slowest(_own_modules)}")
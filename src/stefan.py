@@ -1,37 +1,112 @@
+import asyncio
+import logging
+import time
+
 import discord
-from difflib import SequenceMatcher
 from discord.ext import commands
 
+import startup
 from log import get_logger
+from command_index import CommandIndex
+from metrics import metrics, MetricsServer
+from watchdog import LoopWatchdog
 
 from config import config
 from cogs import Music, Misc
 
 logger = get_logger(__name__)
 
+command_seconds = metrics.histogram("stefan_command_seconds", "How long commands take", ["command"])
+command_failures = metrics.counter("stefan_command_failures_total", "Commands that raised an error", ["command"])
+discord_requests = metrics.counter("stefan_discord_requests_total", "Calls to the Discord API",
+                                   ["method", "route", "status"])
+
 class Stefan(commands.Bot):
     
     def __init__(self, *args, **kwargs):
         commands.Bot.__init__(self, *args, **kwargs)
 
-        self.latest_context = None
+        # The latest context of every guild, so that we know where to answer
+        self.latest_contexts = {}
+
+        # Used to guess which command was meant when someone misspells one
+        self.command_index = CommandIndex(threshold=0.3)
+
+        self.metrics_server = None
+        self.watchdog = None
+        self._count_discord_requests()
         
         self.before_invoke(self._handle_before_invoke)
         self.after_invoke(self._handle_after_invoke)
 
+    def _count_discord_requests(self):
+        """
+        Count every call we make to the Discord API, by its route (like
+        '/channels/{channel_id}/messages') and how it went: 'ok', the status
+        code we got instead, or 'error' if we never got an answer.
+        """
+
+        request = self.http.request
+
+        async def counted_request(route, **kwargs):
+            status = "error"
+            try:
+                response = await request(route, **kwargs)
+                status = "ok"
+                return response
+            except discord.HTTPException as e:
+                status = str(e.status)
+                raise
+            finally:
+                discord_requests.inc(method=route.method, route=route.path, status=status)
+
+        self.http.request = counted_request
+
     async def _handle_before_invoke(self, ctx):
-        command = f"Command: _{ctx.command}"
-        args = ', '.join(['self', 'ctx'] + [f"'{arg}'" for arg in ctx.args[2:]])
-        logger.debug(f"{command}({args}) [source: '{ctx.message.content}']")
+        ctx.invoked_at = time.perf_counter()
+
+        # This runs for every command, so don't build the message unless it
+        # is actually logged
+        if logger.isEnabledFor(logging.DEBUG):
+            args = ', '.join(['self', 'ctx'] + [f"'{arg}'" for arg in ctx.args[2:]])
+            logger.debug("Command: _%s(%s) [source: '%s']", ctx.command, args, ctx.message.content)
         
-        self.latest_context = ctx
+        if ctx.guild:
+            self.latest_contexts[ctx.guild.id] = ctx
         await ctx.message.add_reaction("👌")
 
     async def setup_hook(self):
         await self.add_cog(Music(self, config))
         await self.add_cog(Misc(self, config))
+        startup.mark("add cogs")
+
+        if (threshold := config.get("loop_lag_threshold")):
+            self.watchdog = LoopWatchdog(asyncio.get_running_loop(), config.get("loop_lag_interval"), threshold)
+            self.watchdog.start()
+
+        if (port := config.get("metrics_port")):
+            self.metrics_server = MetricsServer(metrics, config.get("metrics_host"), port)
+            await self.metrics_server.start()
+
+    async def add_cog(self, cog, *args, **kwargs):
+        await super().add_cog(cog, *args, **kwargs)
+        self._build_command_index()
+
+    async def remove_cog(self, name, *args, **kwargs):
+        cog = await super().remove_cog(name, *args, **kwargs)
+        self._build_command_index()
+        return cog
+
+    def _build_command_index(self):
+        self.command_index.build(command for cog in self.cogs.values() for command in cog.get_commands())
     
     async def _handle_after_invoke(self, ctx):
+        name = str(ctx.command)
+        command_seconds.observe(time.perf_counter() - ctx.invoked_at, command=name)
+
+        if ctx.command_failed:
+            command_failures.inc(command=name)
+
         await ctx.message.remove_reaction("👌", self.user)
         await ctx.message.add_reaction("👍")
 
@@ -39,29 +114,36 @@ class Stefan(commands.Bot):
         for cog in self.cogs.values():
             await cog.close()
 
-        if self.latest_context:
-            await self.latest_context.send("Jag dör! 😱")
+        if self.watchdog:
+            self.watchdog.stop()
 
-            if self.latest_context.guild.voice_client:
-                await self.latest_context.guild.voice_client.disconnect()
+        if self.metrics_server:
+            await self.metrics_server.stop()
+
+        for ctx in self.latest_contexts.values():
+            await ctx.send("Jag dör! 😱")
+
+            if ctx.guild.voice_client:
+                await ctx.guild.voice_client.disconnect()
 
         return await super().close()
 
+    def get_latest_context(self, guild):
+        """
+        Return the latest context in guild. May return None.
+        """
+        return self.latest_contexts.get(guild.id)
+
     def get_voice_client(self, ctx):
         """
         Return the bots voice client. May return None.
         """
         return discord.utils.get(self.voice_clients, guild=ctx.guild)
 
-    async def join_channel(self):
+    async def join_channel(self, ctx):
         """
-        Joins the users channel given the current context.
+        Joins the users channel given the context.
         """
-        if not self.latest_context:
-            return
-
-        ctx = self.latest_context
-        
         if ctx.author and ctx.author.voice:
             if ctx.guild and ctx.guild.voice_client:
                 if ctx.author.voice.channel != ctx.guild.voice_client.channel:
@@ -70,6 +152,10 @@ class Stefan(commands.Bot):
                 await ctx.author.voice.channel.connect()
 
     async def on_ready(self):
+        startup.mark("log in")
+        if (report := startup.report()):
+            logger.info(report)
+
         print("Stefan anmäler sig för tjänstgöring.")
         await self.change_presence(activity=discord.Activity(type=discord.ActivityType.listening, name="ert skitsnack"))
 
@@ -87,45 +173,18 @@ class Stefan(commands.Bot):
 
     async def on_command_error(self, ctx, error):
         if isinstance(error, discord.ext.commands.CommandNotFound):
-            commands = []
-            ratios = []
-            invokes = []
-            
-            for cog in self.cogs.values():
-                for command in cog.get_commands():
-                    commands.append(command)
-
-                    max_ratio = SequenceMatcher(None, ctx.invoked_with, command.name).ratio()
-                    invoke = command.name
-
-                    for alias in command.aliases:
-                        ratio = SequenceMatcher(None, ctx.invoked_with, alias).ratio()
-                        if ratio > max_ratio:
-                            max_ratio = ratio
-                            invoke = alias
-                    
-                    ratios.append(max_ratio)
-                    invokes.append(invoke)
-
-            max_index = 0
-            current_index = 0
-            max_ratio = 0
-
-            for ratio in ratios:
-                if ratio > max_ratio:
-                    max_ratio = ratio
-                    max_index = current_index
-                current_index += 1
-
-            if max_ratio > 0.3:
+            match = self.command_index.lookup(ctx.invoked_with)
+
+            if match:
+                command, invoke = match
                 args = ctx.message.content.split()[1:]
 
-                await ctx.send(f"Jag antar att du ville skriva {invokes[max_index]}? 🤔")
-                ctx.args = [commands[max_index], ctx, *args]
-                ctx.invoked_with = commands[max_index].name
-                ctx.command = commands[max_index].name
+                await ctx.send(f"Jag antar att du ville skriva {invoke}? 🤔")
+                ctx.args = [command, ctx, *args]
+                ctx.invoked_with = command.name
+                ctx.command = command.name
                 await self._handle_before_invoke(ctx)
-                await commands[max_index].__call__(ctx, *args)
+                await command.__call__(ctx, *args)
                 await self._handle_after_invoke(ctx)
             else:
                 await ctx.send("Njae, nu har du nog skrivit något tokigt... 🤔")
@@ -146,4 +205,6 @@ class Stefan(commands.Bot):
         # disconnected
         for cog in self.cogs.values():
             if hasattr(cog, 'stefan_on_disconnect') and callable(cog.stefan_on_disconnect):
-                cog.stefan_on_disconnect()
+                cog.stefan_on_disconnect(voice_client.guild)
+
+        self.latest_contexts.pop(voice_client.guild.id, None)
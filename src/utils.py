@@ -1,3 +1,18 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import importlib
+import time
+from types import ModuleType
+from typing import Any, Callable, Iterable, Iterator, Optional, TypeVar
+
+from log import get_logger
+
+logger = get_logger(__name__)
+
+T = TypeVar('T')
+R = TypeVar('R')
+
+
 def format_time(time: int, show_hours=False):
     
     hours = time // 3600
@@ -9,3 +24,146 @@ def format_time(time: int, show_hours=False):
     else:
         return f"{minutes:02}:{seconds:02}"
 
+
+class LazyModule:
+    """
+    Stands in for a module that is slow to import and isn't needed right
+    away, like youtube_dl. It is imported the first time one of its
+    attributes is used.
+    """
+
+    def __init__(self, name: str):
+        self._name = name
+        self._module: Optional[ModuleType] = None
+
+    def __getattr__(self, attribute: str) -> Any:
+        if self._module is None:
+            start = time.perf_counter()
+            self._module = importlib.import_module(self._name)
+            logger.info(f"Imported '{self._name}' on first use in {(time.perf_counter() - start) * 1000:.0f} ms")
+
+        return getattr(self._module, attribute)
+
+
+def ordered_map(function: Callable[[T], R], items: Iterable[T], concurrency: int) -> Iterator[R]:
+    """
+    Like map, but calls function for up to concurrency items at the same time
+    in worker threads. Results are still yielded in the same order as items, 
+    each one as soon as it and every result before it is done.
+    """
+
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    pending = deque()
+
+    try:
+        for item in items:
+            pending.append(executor.submit(function, item))
+
+            # Don't run too far ahead of the consumer, but keep enough work
+            # queued up for every worker to stay busy
+            if len(pending) >= 2 * concurrency:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+    finally:
+        # If the consumer stops early we don't want to keep doing work for it
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+class MaxTree:
+    """
+    A list of non-negative numbers that can tell the largest number in any
+    range in O(log n) and of all of them in O(1). Changing or appending a
+    number is O(log n), inserting or removing one costs as much as the
+    numbers after it, so it is cheapest towards the end.
+    """
+
+    def __init__(self, values: Iterable[float] = ()):
+        self._values = list(values)
+        self._build()
+
+    def __len__(self):
+        return len(self._values)
+
+    def _build(self):
+        self._size = 1
+        while self._size < len(self._values):
+            self._size *= 2
+
+        self._tree = [0] * (2 * self._size)
+        self._tree[self._size:self._size + len(self._values)] = self._values
+
+        for i in range(self._size - 1, 0, -1):
+            self._tree[i] = max(self._tree[2 * i], self._tree[2 * i + 1])
+
+    def _refresh(self, start: int, end: int):
+        """
+        Copy the values in [start, end) to the leaves and update everything
+        above them, one level at a time.
+        """
+
+        if start >= end:
+            return
+
+        for i in range(start, end):
+            self._tree[self._size + i] = self._values[i] if i < len(self._values) else 0
+
+        low, high = self._size + start, self._size + end - 1
+        while low > 1:
+            low, high = low // 2, high // 2
+            for i in range(low, high + 1):
+                self._tree[i] = max(self._tree[2 * i], self._tree[2 * i + 1])
+
+    def __setitem__(self, index: int, value: float):
+        self._values[index] = value
+        self._refresh(index, index + 1)
+
+    def append(self, value: float):
+        self.insert(len(self._values), value)
+
+    def insert(self, index: int, value: float):
+        self._values.insert(index, value)
+
+        if len(self._values) > self._size:
+            # Doubles the size, so this happens rarely enough to be O(1)
+            # amortized when appending
+            self._build()
+        else:
+            self._refresh(index, len(self._values))
+
+    def pop(self, index: int):
+        self._values.pop(index)
+
+        # The last leaf is cleared as well, since everything moved one step
+        self._refresh(index, len(self._values) + 1)
+
+    def reset(self, values: Iterable[float] = ()):
+        self._values = list(values)
+        self._build()
+
+    def max(self, start: int = 0, end: int = None) -> float:
+        """
+        The largest number in [start, end), or 0 if the range is empty.
+        """
+
+        end = len(self._values) if end is None else min(end, len(self._values))
+
+        if start == 0 and end == len(self._values):
+            return self._tree[1]
+
+        result = 0
+
+        low, high = start + self._size, end + self._size
+        while low < high:
+            if low % 2:
+                result = max(result, self._tree[low])
+                low += 1
+            if high % 2:
+                high -= 1
+                result = max(result, self._tree[high])
+            low //= 2
+            high //= 2
+
+        return result
@@ -0,0 +1,149 @@
+"""
+Measures how late the event loop runs what it has scheduled. When something
+blocks it for too long, the stack of the event loop's thread is captured
+from another thread, so that we can see exactly what was blocking it.
+"""
+
+from __future__ import annotations
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+from types import FrameType
+from typing import Optional
+
+from log import get_logger
+from metrics import metrics
+
+logger = get_logger(__name__)
+
+lag_seconds = metrics.histogram("stefan_loop_lag_seconds", "How late the event loop runs scheduled callbacks",
+                                buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+stalls = metrics.counter("stefan_loop_stalls_total", "Times the event loop was blocked longer than the threshold, "
+                         "by the function that was blocking it", ["function"])
+
+# Frames from files in here are our own code, which is usually what we want to
+# blame rather than the library it happens to be calling
+_SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Everything outside the callback the loop is running is the loop itself
+_LOOP_FILE = os.path.abspath(asyncio.events.__file__)
+
+
+class LoopWatchdog:
+    """
+    Every interval seconds a callback is scheduled on loop, and how late it
+    runs is recorded as the lag. A helper thread checks that the callbacks
+    keep coming, and when one is more than threshold seconds late it logs the
+    stack of the loop's thread and the task that was running.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, interval: float, threshold: float):
+        self.loop = loop
+        self.interval = interval
+        self.threshold = threshold
+
+        self._loop_thread_id: Optional[int] = None
+        self._handle: Optional[asyncio.TimerHandle] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+
+        # When the latest tick ran, and the blocking function found by the
+        # helper thread during the current stall, if any
+        self._last_tick = time.perf_counter()
+        self._blocker: Optional[str] = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        Start watching. Must be called on the event loop.
+        """
+
+        self._loop_thread_id = threading.get_ident()
+        self._last_tick = time.perf_counter()
+        self._schedule()
+
+        self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+        if self._handle:
+            self._handle.cancel()
+            self._handle = None
+
+    def _schedule(self):
+        self._handle = self.loop.call_later(self.interval, self._tick, self.loop.time() + self.interval)
+
+    def _tick(self, expected: float):
+        lag = max(0, self.loop.time() - expected)
+        lag_seconds.observe(lag)
+
+        with self._lock:
+            self._last_tick = time.perf_counter()
+            blocker, self._blocker = self._blocker, None
+
+        if blocker:
+            logger.warning(f"The event loop was blocked for {lag * 1000:.0f} ms by {blocker}")
+            stalls.inc(function=blocker)
+
+        self._schedule()
+
+    def _watch(self):
+        # Check often enough that a stall is noticed soon after it crosses the
+        # threshold, while the blocking call is still on the stack
+        while not self._stopped.wait(min(self.interval, self.threshold) / 2):
+            with self._lock:
+                if self._blocker or time.perf_counter() - self._last_tick < self.interval + self.threshold:
+                    continue
+
+                if (frame := sys._current_frames().get(self._loop_thread_id)) is None:
+                    continue
+
+                # The stack has to be read before the loop moves on
+                blocker = self._blocker = LoopWatchdog._blame(frame)
+                stack = LoopWatchdog._format_stack(frame)
+
+                task = asyncio.current_task(self.loop)
+                coroutine = task.get_coro().__qualname__ if task else "a callback"
+
+            logger.warning(f"The event loop has been blocked for more than {self.threshold * 1000:.0f} ms "
+                           f"by {blocker} (in {coroutine}), at:\n{stack}")
+
+    @staticmethod
+    def _format_stack(frame: FrameType) -> str:
+        """
+        The stack of frame, starting at the callback the loop is running.
+        """
+
+        entries = traceback.extract_stack(frame)
+        loop_entries = [index for index, entry in enumerate(entries) if os.path.abspath(entry.filename) == _LOOP_FILE]
+
+        if loop_entries:
+            entries = entries[loop_entries[-1] + 1:]
+
+        return ''.join(traceback.format_list(entries))
+
+    @staticmethod
+    def _blame(frame: FrameType) -> str:
+        """
+        The innermost function on the stack of frame that is our own code, or
+        the innermost function if none of them are. Only the callback the loop
+        is running counts, not the loop itself or what started it.
+        """
+
+        innermost = frame
+
+        while frame and (filename := os.path.abspath(frame.f_code.co_filename)) != _LOOP_FILE:
+            if filename.startswith(_SOURCE_DIR):
+                break
+            frame = frame.f_back
+        else:
+            frame = innermost
+
+        module = frame.f_globals.get('__name__', '?')
+        name = getattr(frame.f_code, 'co_qualname', frame.f_code.co_name)
+        return f"{module}.{name}"